@@ -0,0 +1,147 @@
+"""Display formatting of scaled US amounts as whole numbers and fractions."""
+
+from bisect import bisect_left
+from fractions import Fraction
+import numpy as np
+
+# largest denominator shown, e.g. 1/32 of a cup
+MAX_DENOMINATOR = 32
+
+# formatted amounts kept before the memo is emptied
+MEMO_SIZE = 4096
+
+
+def farey_table(max_denominator):
+    """Return the fractions from 0 to 1 with denominators up to max_denominator.
+
+    Returns parallel lists of values, numerators and denominators, sorted
+    by value.
+    """
+
+    fractions = set()
+    for denominator in xrange(1, max_denominator + 1):
+        for numerator in xrange(denominator + 1):
+            fractions.add(Fraction(numerator, denominator))
+
+    fractions = sorted(fractions)
+
+    return ([float(fraction) for fraction in fractions],
+            [fraction.numerator for fraction in fractions],
+            [fraction.denominator for fraction in fractions])
+
+
+values, numerators, denominators = farey_table(MAX_DENOMINATOR)
+
+# the same table as arrays, for formatting many amounts at once
+value_array = np.array(values)
+numerator_array = np.array(numerators)
+denominator_array = np.array(denominators)
+
+amount_memo = {}
+
+
+def nearest_fraction(value):
+    """Return (numerator, denominator) of the closest table fraction to value.
+
+    value is between 0 and 1. Gives the same result as
+    Fraction(value).limit_denominator(MAX_DENOMINATOR), which is used
+    for the rare value that is as close to both of its neighbors.
+    """
+
+    i = bisect_left(values, value)
+
+    if i == 0:
+        return numerators[0], denominators[0]
+    if i == len(values):
+        return numerators[-1], denominators[-1]
+
+    below = value - values[i - 1]
+    above = values[i] - value
+
+    if abs(below - above) < 1e-12:
+        fraction = Fraction(value).limit_denominator(MAX_DENOMINATOR)
+        return fraction.numerator, fraction.denominator
+
+    if below < above:
+        i -= 1
+
+    return numerators[i], denominators[i]
+
+
+def format_amount(value):
+    """Return value as a display string like "2", "3/4" or "1 1/2"."""
+
+    if value in amount_memo:
+        return amount_memo[value]
+
+    whole_num = int(value)
+    numerator, denominator = nearest_fraction(value - whole_num)
+
+    # e.g. 2.99 rounds up to 3 rather than "2 1"
+    if numerator == denominator:
+        whole_num += 1
+        numerator = 0
+
+    if numerator == 0:
+        amount = str(whole_num)
+    elif whole_num == 0:
+        amount = "%s/%s" % (numerator, denominator)
+    else:
+        amount = "%s %s/%s" % (whole_num, numerator, denominator)
+
+    if len(amount_memo) >= MEMO_SIZE:
+        amount_memo.clear()
+    amount_memo[value] = amount
+
+    return amount
+
+
+def format_amounts(amounts):
+    """Return display strings for a list of decimal amounts."""
+
+    memo = amount_memo
+
+    return [memo[value] if value in memo else format_amount(value) for value in amounts]
+
+
+def format_amount_array(amounts):
+    """Return display strings for a NumPy array of decimal amounts.
+
+    Scaled amounts repeat a lot, so each distinct amount is formatted
+    once: the closest table fraction of every one is found with a single
+    vectorized search. Gives the same strings as format_amount.
+    """
+
+    unique_amounts, inverse = np.unique(amounts, return_inverse=True)
+
+    whole_nums = np.floor(unique_amounts).astype(int)
+    parts = unique_amounts - whole_nums
+
+    above_i = np.clip(np.searchsorted(value_array, parts), 1, len(values) - 1)
+    below = parts - value_array[above_i - 1]
+    above = value_array[above_i] - parts
+    i = np.where(below < above, above_i - 1, above_i)
+
+    found_numerators = numerator_array[i]
+    found_denominators = denominator_array[i]
+
+    # as close to both neighbors: settle it as limit_denominator does
+    for tie in np.flatnonzero(np.abs(below - above) < 1e-12):
+        found_numerators[tie], found_denominators[tie] = nearest_fraction(parts[tie])
+
+    carry = found_numerators == found_denominators
+    whole_nums[carry] += 1
+    found_numerators[carry] = 0
+
+    formatted = []
+    for whole_num, numerator, denominator in zip(whole_nums.tolist(),
+                                                 found_numerators.tolist(),
+                                                 found_denominators.tolist()):
+        if numerator == 0:
+            formatted.append(str(whole_num))
+        elif whole_num == 0:
+            formatted.append("%s/%s" % (numerator, denominator))
+        else:
+            formatted.append("%s %s/%s" % (whole_num, numerator, denominator))
+
+    return np.array(formatted, dtype=object)[inverse].tolist()
@@ -0,0 +1,515 @@
+"""Generate large synthetic catalogs and benchmark the app's routes.
+
+Generate a catalog of 100k recipes (with users and recipe boxes) into a
+local database, then time every read-only route against it:
+
+    python benchmark.py generate postgresql:///benchrecipes --recipes 100000
+    python benchmark.py run postgresql:///benchrecipes --requests 200
+
+Any SQLAlchemy URI works, e.g. sqlite:////tmp/benchrecipes.db. Both
+commands take --seed, so catalogs and request mixes are repeatable.
+
+Micro-benchmarks of single functions need no database:
+
+    python benchmark.py amounts
+    python benchmark.py scaling
+"""
+
+import argparse
+import bisect
+import math
+import random
+import time
+import timeit
+from fractions import Fraction
+from sqlalchemy import event
+from werkzeug.urls import url_encode
+from model import connect_to_db, db
+from model import User, Box, RecipeBox, Recipe, Website, Serving, Ingredient, USUnit, MetricUnit, USAmount, MetricAmount, Instruction, Course, RecipeIngredient, IngredientType, RecipeServing, USIngredientMeasure, MetricIngredientMeasure, RecipeCourse
+from server import app
+from seed import load_similar_recipes, load_recipe_documents, load_recipe_conversions
+from caches import bump_catalog_version, get_cache_stats
+from amounts import format_amounts, amount_memo
+from functions import convert_measures, pack_measures, scale_packed
+import bcrypt
+
+# vocabulary the synthetic recipes are built from
+INGREDIENT_TYPES = {
+    "Produce": ["garlic", "red onion", "onion", "lemon", "lime", "avocado", "tomato", "spinach",
+                "kale", "carrot", "celery", "bell pepper", "cauliflower", "broccoli", "zucchini",
+                "sweet potato", "potato", "mushroom", "ginger", "cilantro", "parsley", "basil",
+                "strawberry", "banana", "blueberry", "watermelon", "mango", "apple", "rhubarb",
+                "jalapeno", "cucumber", "cabbage", "beet", "butternut squash", "green onion"],
+    "Spices and Seasonings": ["sea salt", "black pepper", "cumin", "smoked paprika", "chili powder",
+                              "cinnamon", "turmeric", "oregano", "thyme", "red pepper flake",
+                              "garlic powder", "onion powder", "nutmeg", "cardamom", "curry powder"],
+    "Canned and Jarred": ["chickpeas", "black beans", "kidney beans", "coconut milk", "tomato paste",
+                          "diced tomatoes", "sun-dried tomatoes", "vegetable broth", "white beans"],
+    "Baking": ["almond flour", "coconut flour", "oat flour", "baking soda", "baking powder",
+               "cornstarch", "vanilla extract", "cocoa powder", "vegan dark chocolate", "coconut sugar"],
+    "Nut Butters and Jams": ["almond butter", "peanut butter", "tahini", "strawberry jam"],
+    "Oil, Vinegar, Dressing": ["olive oil", "coconut oil", "avocado oil", "apple cider vinegar",
+                               "balsamic vinegar", "sesame oil", "rice vinegar"],
+    "Pasta and Rice": ["brown rice", "quinoa", "rolled oats", "spaghetti", "rice noodles", "couscous"],
+    "Nuts": ["cashews", "almonds", "walnuts", "pecans", "pine nuts", "pumpkin seeds", "chia seeds",
+             "hemp seeds", "flaxseed"],
+    "Dairy Alternatives": ["almond milk", "coconut yogurt", "vegan butter", "nutritional yeast"],
+    "Sweeteners": ["maple syrup", "agave nectar", "medjool dates"],
+    "Condiments": ["tamari", "sriracha", "dijon mustard", "miso paste", "vegan mayo"],
+    "Other": ["water", "ice", "extra-firm tofu", "tempeh"],
+}
+INGREDIENT_PREFIXES = ["", "fresh", "dried", "roasted", "toasted", "organic", "chopped", "frozen",
+                       "raw", "smoked", "sprouted", "unsweetened"]
+COURSES = ["Entree", "Side", "Dessert", "Appetizer", "Breakfast", "Snack", "Salad", "Soup",
+           "Beverage", "Sauce"]
+DISHES = ["Burgers", "Bowl", "Salad", "Soup", "Curry", "Tacos", "Bars", "Crumble", "Pasta",
+          "Stir-Fry", "Smoothie", "Cookies", "Stuffed Peppers", "Chili", "Sashimi", "Muffins"]
+US_UNITS = ["cup", "cups", "tbsp", "tsp", "cloves", "head", "15-ounce can", "pinch"]
+METRIC_UNITS = ["g", "ml"]
+TIMES = [10, 15, 20, 25, 30, 40, 45, 60, 75, 90, 120, 180]
+WEBSITES = ["Minimalist Baker", "Oh She Glows", "Cookie and Kate", "Love and Lemons"]
+SERVING_SIZES = range(1, 13)
+
+# rows per bulk insert
+CHUNK_SIZE = 10000
+
+
+def weighted_picker(rng, count, exponent=1.0):
+    """Return a function picking indexes 0..count-1 with Zipf-like weights.
+
+    A few ingredients (salt, garlic, olive oil) appear in most recipes and
+    the long tail in very few, as in real catalogs.
+    """
+
+    totals = []
+    total = 0.0
+    for rank in xrange(count):
+        total += 1.0 / (rank + 1) ** exponent
+        totals.append(total)
+
+    return lambda: bisect.bisect(totals, rng.random() * total)
+
+
+def make_ingredients(rng):
+    """Return a shuffled list of unique (ingredient_name, type_name) pairs."""
+
+    ingredients = []
+    for type_name in sorted(INGREDIENT_TYPES):
+        for base in INGREDIENT_TYPES[type_name]:
+            for prefix in INGREDIENT_PREFIXES:
+                ingredients.append(((prefix + " " + base).strip(), type_name))
+
+    rng.shuffle(ingredients)
+
+    return ingredients
+
+
+def make_us_amounts():
+    """Return (us_amount, us_decimal) pairs for whole and fractional amounts."""
+
+    fractions = [("", 0), ("1/4", 0.25), ("1/3", 0.33), ("1/2", 0.5), ("2/3", 0.67), ("3/4", 0.75)]
+    amounts = []
+
+    for whole in xrange(9):
+        for fraction, decimal in fractions:
+            if not whole and not fraction:
+                continue
+            amount = (str(whole) + " " + fraction if whole else fraction).strip()
+            amounts.append((amount, whole + decimal))
+
+    return amounts
+
+
+def insert_rows(table, rows):
+    """Bulk insert rows (dictionaries) into table, in chunks."""
+
+    for start in xrange(0, len(rows), CHUNK_SIZE):
+        db.session.execute(table.__table__.insert(), rows[start:start + CHUNK_SIZE])
+
+
+def reset_sequences():
+    """Move Postgres id sequences past the explicitly inserted ids."""
+
+    if db.engine.dialect.name != "postgresql":
+        return
+
+    for table in db.metadata.sorted_tables:
+        for column in table.primary_key.columns:
+            db.session.execute("SELECT setval(pg_get_serial_sequence('%s', '%s'), COALESCE(MAX(%s), 0) + 1, false) FROM %s"
+                               % (table.name, column.name, column.name, table.name))
+
+
+def generate_catalog(recipes, users, seed=0, similar=False):
+    """Replace the database with a synthetic catalog of recipes and users.
+
+    Ids are assigned here so every table can be written with bulk
+    inserts, one chunk of recipes at a time. Recipe documents and
+    conversions are built too, as a reseed does, so timed requests read
+    them instead of building and storing them on first view.
+    """
+
+    rng = random.Random(seed)
+
+    db.drop_all()
+    db.create_all()
+
+    ingredients = make_ingredients(rng)
+    type_names = sorted(INGREDIENT_TYPES)
+    us_amounts = make_us_amounts()
+    metric_amounts = [amount * 5 for amount in xrange(1, 201)]
+
+    insert_rows(Website, [{"site_id": i + 1, "site_name": name} for i, name in enumerate(WEBSITES)])
+    insert_rows(Serving, [{"serving_id": size, "serving_size": size} for size in SERVING_SIZES])
+    insert_rows(Course, [{"course_id": i + 1, "course_name": name} for i, name in enumerate(COURSES)])
+    insert_rows(IngredientType, [{"type_id": i + 1, "type_name": name} for i, name in enumerate(type_names)])
+    insert_rows(Ingredient, [{"ingredient_id": i + 1,
+                              "ingredient_name": name,
+                              "type_id": type_names.index(type_name) + 1}
+                             for i, (name, type_name) in enumerate(ingredients)])
+    insert_rows(USUnit, [{"us_unit_id": i + 1, "us_unit": unit} for i, unit in enumerate(US_UNITS)])
+    insert_rows(MetricUnit, [{"metric_unit_id": i + 1, "metric_unit": unit} for i, unit in enumerate(METRIC_UNITS)])
+    insert_rows(USAmount, [{"us_amount_id": i + 1, "us_amount": amount, "us_decimal": decimal}
+                           for i, (amount, decimal) in enumerate(us_amounts)])
+    insert_rows(MetricAmount, [{"metric_amount_id": i + 1, "metric_amount": amount}
+                               for i, amount in enumerate(metric_amounts)])
+    db.session.commit()
+
+    pick_ingredient = weighted_picker(rng, len(ingredients))
+    pinch = US_UNITS.index("pinch") + 1
+    recipeingredient_id = 0
+    instruction_id = 0
+
+    for start in xrange(0, recipes, CHUNK_SIZE):
+        tables = dict((table, []) for table in [Recipe, RecipeIngredient, USIngredientMeasure,
+                                                MetricIngredientMeasure, Instruction,
+                                                RecipeServing, RecipeCourse])
+
+        for recipe_id in xrange(start + 1, min(start + CHUNK_SIZE, recipes) + 1):
+            chosen = set()
+            for i in xrange(rng.randint(4, 16)):
+                chosen.add(pick_ingredient())
+            chosen = sorted(chosen, key=lambda i: rng.random())
+
+            main = ingredients[chosen[0]][0]
+            tables[Recipe].append({"recipe_id": recipe_id,
+                                   "recipe_api_id": recipe_id,
+                                   "recipe_name": "%s %s %s" % (main.title(), rng.choice(DISHES), recipe_id),
+                                   "time_in_min": rng.choice(TIMES),
+                                   "src_url": "http://example.com/recipe-%s/" % recipe_id,
+                                   "img_url": "/static/img/Vegan_clipart.png",
+                                   "site_id": rng.randint(1, len(WEBSITES))})
+
+            for i in chosen:
+                recipeingredient_id += 1
+                # some amounts have no unit, as in "2 avocados"
+                unit_id = rng.randint(1, len(US_UNITS)) if rng.random() < 0.85 else None
+                amount_ids = [rng.randint(1, len(us_amounts))]
+                if rng.random() < 0.1:
+                    amount_ids.append(rng.randint(amount_ids[0], len(us_amounts)))
+
+                tables[RecipeIngredient].append({"recipeingredient_id": recipeingredient_id,
+                                                 "recipe_id": recipe_id,
+                                                 "ingredient_id": i + 1,
+                                                 "original_string": ingredients[i][0],
+                                                 "link": None})
+
+                if unit_id == pinch:
+                    tables[USIngredientMeasure].append({"recipeingredient_id": recipeingredient_id,
+                                                        "us_unit_id": unit_id,
+                                                        "us_amount_id": None})
+                    continue
+
+                for amount_id in amount_ids:
+                    tables[USIngredientMeasure].append({"recipeingredient_id": recipeingredient_id,
+                                                        "us_unit_id": unit_id,
+                                                        "us_amount_id": amount_id})
+
+                if rng.random() < 0.6:
+                    tables[MetricIngredientMeasure].append({"recipeingredient_id": recipeingredient_id,
+                                                            "metric_unit_id": rng.randint(1, len(METRIC_UNITS)),
+                                                            "metric_amount_id": rng.randint(1, len(metric_amounts))})
+
+            for step in xrange(1, rng.randint(3, 8) + 1):
+                instruction_id += 1
+                tables[Instruction].append({"instruction_id": instruction_id,
+                                            "recipe_id": recipe_id,
+                                            "step_order": step,
+                                            "step_instruction": "Combine the %s and mix well." % ingredients[rng.choice(chosen)][0]})
+
+            tables[RecipeServing].append({"recipe_id": recipe_id,
+                                          "serving_id": rng.choice(SERVING_SIZES)})
+
+            for course_id in rng.sample(xrange(1, len(COURSES) + 1), rng.randint(1, 2)):
+                tables[RecipeCourse].append({"recipe_id": recipe_id,
+                                             "course_id": course_id})
+
+        for table in [Recipe, RecipeIngredient, USIngredientMeasure, MetricIngredientMeasure,
+                      Instruction, RecipeServing, RecipeCourse]:
+            insert_rows(table, tables[table])
+        db.session.commit()
+
+        print "Recipes", min(start + CHUNK_SIZE, recipes)
+
+    # every synthetic user shares one password, as bcrypt is slow on purpose
+    password = bcrypt.hashpw("benchmark", bcrypt.gensalt())
+    user_rows = []
+    box_rows = []
+    recipebox_rows = []
+
+    for user_id in xrange(1, users + 1):
+        user_rows.append({"user_id": user_id,
+                          "username": "user%s" % user_id,
+                          "password": password})
+
+        for i in xrange(rng.randint(1, 5)):
+            box_id = len(box_rows) + 1
+            box_rows.append({"box_id": box_id,
+                             "user_id": user_id,
+                             "label_name": "Box %s" % (i + 1)})
+
+            for recipe_id in rng.sample(xrange(1, recipes + 1), min(recipes, rng.randint(3, 20))):
+                recipebox_rows.append({"recipe_id": recipe_id,
+                                       "box_id": box_id,
+                                       "recipe_notes": "Try this one"})
+
+    insert_rows(User, user_rows)
+    insert_rows(Box, box_rows)
+    insert_rows(RecipeBox, recipebox_rows)
+
+    reset_sequences()
+    db.session.commit()
+
+    bump_catalog_version()
+
+    print "Users", users
+
+    if similar:
+        load_similar_recipes()
+
+    # documents list similar recipes, so they are built after them
+    load_recipe_documents()
+    load_recipe_conversions()
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of sorted values."""
+
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+
+    return values[max(rank, 1) - 1]
+
+
+def route_cases(rng):
+    """Return (name, logged_in, url function) for each read-only route.
+
+    Each url function draws fresh parameters from the catalog, so a run
+    mixes cached and uncached searches like real traffic.
+    """
+
+    recipe_ids = [recipe_id for recipe_id, in db.session.query(Recipe.recipe_id).all()]
+    ingredient_names = [name for name, in db.session.query(Ingredient.ingredient_name).all()]
+    course_names = [name for name, in db.session.query(Course.course_name).all()]
+
+    def results(search_term, ingredient_count, **params):
+        def url():
+            args = [("search-term", search_term)]
+            for name in rng.sample(ingredient_names, ingredient_count):
+                args.append(("ingredient", name))
+            for name, value in params.items():
+                args.append((name, value() if callable(value) else value))
+            return "/results?" + url_encode(args)
+        return url
+
+    return [
+        ("/", False, lambda: "/"),
+        ("/search", False, lambda: "/search"),
+        ("/ingredients.json", False, lambda: "/ingredients.json?" + url_encode({"q": rng.choice(ingredient_names)[:3]})),
+        ("/results any", False, results("any", 2)),
+        ("/results all", False, results("all", 2, course=lambda: rng.choice(course_names))),
+        ("/results ranked", False, results("any", 3, order="rank")),
+        ("/results pantry", False, results("pantry", 12, missing=1)),
+        ("/results time", False, results("all", 0, time=lambda: rng.choice(TIMES))),
+        ("/recipe/<id>", False, lambda: "/recipe/%s" % rng.choice(recipe_ids)),
+        ("/show_conversion.json", False, lambda: "/show_conversion.json?recipe_id=%s&serving=%s"
+                                                 % (rng.choice(recipe_ids), rng.choice(SERVING_SIZES))),
+        ("/profile", True, lambda: "/profile"),
+        ("/preview.html", True, lambda: "/preview.html"),
+        ("/my_recipes", True, lambda: "/my_recipes"),
+        ("/my_recipes.json", True, lambda: "/my_recipes.json"),
+        ("/save_recipe/<id>", True, lambda: "/save_recipe/%s" % rng.choice(recipe_ids)),
+    ]
+
+
+def run_benchmark(requests, warmup=5, seed=0):
+    """Time each route and print latency percentiles and query counts."""
+
+    rng = random.Random(seed)
+    queries = []
+
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", count_query)
+
+    client = app.test_client()
+    user_ids = [user_id for user_id, in db.session.query(Box.user_id).distinct().all()]
+
+    print "%-24s %6s %9s %9s %9s %9s %9s" % ("route", "n", "p50 ms", "p95 ms", "p99 ms", "queries", "max q")
+
+    for name, logged_in, url in route_cases(rng):
+        timings = []
+        counts = []
+
+        for i in xrange(warmup + requests):
+            if logged_in:
+                user_id = rng.choice(user_ids)
+                with client.session_transaction() as session:
+                    session["user_id"] = user_id
+                    session["username"] = "user%s" % user_id
+
+            path = url()
+            del queries[:]
+
+            started = time.time()
+            response = client.get(path)
+            response.data
+            elapsed = time.time() - started
+
+            if response.status_code != 200:
+                print "%s returned %s" % (path, response.status_code)
+
+            if i >= warmup:
+                timings.append(elapsed * 1000)
+                counts.append(len(queries))
+
+            db.session.remove()
+
+        timings.sort()
+
+        print "%-24s %6s %9.2f %9.2f %9.2f %9.1f %9s" % (name,
+                                                         len(timings),
+                                                         percentile(timings, 50),
+                                                         percentile(timings, 95),
+                                                         percentile(timings, 99),
+                                                         float(sum(counts)) / len(counts),
+                                                         max(counts))
+
+    event.remove(db.engine, "before_cursor_execute", count_query)
+
+    print
+    print "Cache stats:", get_cache_stats()
+
+
+def fraction_amount(new_decimal):
+    """Format an amount the way convert_us_amt did before amounts.py."""
+
+    whole_num = int(new_decimal)
+
+    if whole_num == 0:
+        new_fraction = str(Fraction(new_decimal).limit_denominator(32))
+    elif (new_decimal - whole_num) == 0.0:
+        new_fraction = str(whole_num)
+    else:
+        if Fraction(new_decimal - whole_num).limit_denominator(32) != 0:
+            new_fraction = str(whole_num) + " " + str(Fraction(new_decimal - whole_num).limit_denominator(32))
+        else:
+            new_fraction = str(whole_num)
+
+    return new_fraction
+
+
+def run_amount_benchmark(repeat=5, seed=0):
+    """Time formatting scaled US amounts with Fractions and with amounts.py."""
+
+    rng = random.Random(seed)
+
+    # every stored amount at every conversion the recipe page offers
+    scaled = [decimal * serving_size / orig_serving
+              for amount, decimal in make_us_amounts()
+              for orig_serving in SERVING_SIZES
+              for serving_size in SERVING_SIZES]
+    rng.shuffle(scaled)
+
+    fraction_time = min(timeit.repeat(lambda: [fraction_amount(value) for value in scaled],
+                                      number=1, repeat=repeat))
+
+    amount_memo.clear()
+    cold_time = timeit.timeit(lambda: format_amounts(scaled), number=1)
+    warm_time = min(timeit.repeat(lambda: format_amounts(scaled), number=1, repeat=repeat))
+
+    # the old path printed amounts like 2.99 as "2 1"
+    differences = [value for value, old, new in zip(scaled, [fraction_amount(value) for value in scaled], format_amounts(scaled))
+                   if old != new and not old.endswith(" 1")]
+
+    per_amount = 1000000.0 / len(scaled)
+
+    print "%s amounts" % len(scaled)
+    print "%-24s %9.3f us/amount" % ("Fraction", fraction_time * per_amount)
+    print "%-24s %9.3f us/amount %6.1fx" % ("format_amounts (cold)", cold_time * per_amount, fraction_time / cold_time)
+    print "%-24s %9.3f us/amount %6.1fx" % ("format_amounts (memo)", warm_time * per_amount, fraction_time / warm_time)
+    print "Differences:", len(differences)
+
+
+def run_scaling_benchmark(recipes=500, repeat=5, seed=0):
+    """Time scaling recipes to every serving size one by one and packed."""
+
+    rng = random.Random(seed)
+    us_amounts = [decimal for amount, decimal in make_us_amounts()]
+
+    all_measures = []
+    for i in xrange(recipes):
+        measures = []
+        for j in xrange(rng.randint(4, 16)):
+            measures.append({'original_string': "ingredient %s" % j,
+                             'link': None,
+                             'us_amounts': rng.sample(us_amounts, rng.choice([1, 1, 1, 2])),
+                             'us_units': [rng.choice(US_UNITS)],
+                             'metric_amounts': [rng.randint(1, 200) * 5.0],
+                             'metric_units': [rng.choice(METRIC_UNITS)]})
+        all_measures.append(measures)
+
+    conversions = [(measures, serving_size / 4.0) for measures in all_measures for serving_size in SERVING_SIZES]
+
+    packed_recipes = [pack_measures(measures, 4) for measures in all_measures]
+    batch = ([packed for packed in packed_recipes for serving_size in SERVING_SIZES],
+             [serving_size / 4.0 for packed in packed_recipes for serving_size in SERVING_SIZES])
+
+    amount_memo.clear()
+    one_by_one = min(timeit.repeat(lambda: [convert_measures(measures, amount) for measures, amount in conversions],
+                                   number=1, repeat=repeat))
+    packed_time = min(timeit.repeat(lambda: scale_packed(*batch), number=1, repeat=repeat))
+
+    same = scale_packed(*batch) == [convert_measures(measures, amount) for measures, amount in conversions]
+
+    print "%s recipes x %s serving sizes" % (recipes, len(SERVING_SIZES))
+    print "%-24s %9.2f ms" % ("convert_measures", one_by_one * 1000)
+    print "%-24s %9.2f ms %6.1fx" % ("scale_packed", packed_time * 1000, one_by_one / packed_time)
+    print "Same results:", same
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic catalog generator and route benchmark.")
+    parser.add_argument("command", choices=["generate", "run", "amounts", "scaling"])
+    parser.add_argument("db_uri", nargs="?", help="e.g. postgresql:///benchrecipes or sqlite:////tmp/bench.db")
+    parser.add_argument("--recipes", type=int, default=10000, help="catalog size, e.g. 10000, 100000, 1000000")
+    parser.add_argument("--users", type=int, help="defaults to one user per 100 recipes")
+    parser.add_argument("--requests", type=int, default=100, help="timed requests per route")
+    parser.add_argument("--warmup", type=int, default=5, help="untimed requests per route")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--similar", action="store_true",
+                        help="also precompute similar recipes (slow on large catalogs)")
+    args = parser.parse_args()
+
+    if args.command == "amounts":
+        run_amount_benchmark(seed=args.seed)
+    elif args.command == "scaling":
+        run_scaling_benchmark(seed=args.seed)
+    elif not args.db_uri:
+        parser.error("generate and run need a db_uri")
+    else:
+        connect_to_db(app, args.db_uri)
+
+        if args.command == "generate":
+            generate_catalog(args.recipes, args.users or max(args.recipes / 100, 1), args.seed, args.similar)
+        else:
+            run_benchmark(args.requests, args.warmup, args.seed)
@@ -0,0 +1,199 @@
+"""In-process caches and the catalog and box versions they are checked against.
+
+The versions are kept in the database, so a reseed or a box edit made
+by another process is seen by every worker. Each request reads them
+once, with a single query, the first time a cache needs them.
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+from uuid import uuid4
+from flask import g, session, has_request_context
+from model import db, CatalogVersion, User
+
+# recipe catalog version, and when it last changed, to the second for
+# Last-Modified headers, as last read from the database
+catalog = {"version": None, "modified": datetime.utcnow().replace(microsecond=0)}
+
+# every cache by name, for reporting hit/miss counters
+all_caches = {}
+
+
+def load_versions():
+    """Read the catalog version, and the logged-in user's box version.
+
+    Done once per request; outside a request, the versions last read or
+    bumped in this process are used.
+    """
+
+    if not has_request_context() or "box_versions" in g:
+        return
+
+    user_id = session.get("user_id")
+    row = db.session.query(
+        db.session.query(CatalogVersion.version).filter_by(catalog_id=1).as_scalar(),
+        db.session.query(CatalogVersion.modified).filter_by(catalog_id=1).as_scalar(),
+        db.session.query(User.boxes_version).filter_by(user_id=user_id).as_scalar()).one()
+
+    version, modified, boxes_version = row
+    if version is not None:
+        catalog["version"] = version
+        catalog["modified"] = modified
+
+    g.box_versions = {}
+    if boxes_version is not None:
+        g.box_versions[user_id] = boxes_version
+
+
+def get_catalog_version():
+    """Return the current recipe catalog version."""
+
+    load_versions()
+
+    return catalog["version"]
+
+
+def bump_catalog_version():
+    """Mark every catalog-derived cache and index as stale, in every process."""
+
+    version = uuid4().hex
+    modified = datetime.utcnow().replace(microsecond=0)
+
+    if not CatalogVersion.query.filter_by(catalog_id=1).update({"version": version, "modified": modified}):
+        db.session.add(CatalogVersion(catalog_id=1, version=version, modified=modified))
+    db.session.commit()
+
+    catalog["version"] = version
+    catalog["modified"] = modified
+
+
+def get_catalog_modified():
+    """Return when the recipe catalog last changed."""
+
+    load_versions()
+
+    return catalog["modified"]
+
+
+def get_box_version(user_id):
+    """Return the version of a user's recipe boxes."""
+
+    load_versions()
+
+    if has_request_context() and user_id in g.box_versions:
+        return g.box_versions[user_id]
+
+    version = db.session.query(User.boxes_version).filter_by(user_id=user_id).scalar() or 0
+    if has_request_context():
+        g.box_versions[user_id] = version
+
+    return version
+
+
+def bump_box_version(user_id):
+    """Mark the cached recipe boxes of a user as stale.
+
+    Call it before committing the change to the boxes, so the new
+    version is committed with it. Returns the new version.
+    """
+
+    load_versions()
+
+    # the update locks the row, so the version read back is this one's
+    db.session.execute(User.__table__.update().where(
+        User.user_id == user_id).values(
+        boxes_version=User.boxes_version + 1))
+    version = db.session.query(User.boxes_version).filter_by(user_id=user_id).scalar()
+
+    if has_request_context():
+        g.box_versions[user_id] = version
+
+    return version
+
+
+class LRUCache(object):
+    """Size-bounded cache that evicts the least recently used entry.
+
+    Entries are dropped wholesale when the catalog version changes, so
+    nothing built from an older catalog is ever served.
+    """
+
+    def __init__(self, name, max_size):
+        self.name = name
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.version = get_catalog_version()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+        all_caches[name] = self
+
+    def check_version(self):
+        """Empty the cache if the catalog has changed since it was filled."""
+
+        if self.version != get_catalog_version():
+            self.items.clear()
+            self.version = get_catalog_version()
+
+    def get(self, key):
+        """Return the cached value for key, or None."""
+
+        with self.lock:
+            self.check_version()
+
+            if key not in self.items:
+                self.misses += 1
+                return None
+
+            value = self.items.pop(key)
+            self.items[key] = value
+            self.hits += 1
+
+            return value
+
+    def set(self, key, value):
+        """Cache value for key, evicting the oldest entry if full."""
+
+        with self.lock:
+            self.check_version()
+
+            self.items.pop(key, None)
+            self.items[key] = value
+
+            if len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        """Remove every entry."""
+
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        """Return size and hit/miss counters for sizing the cache."""
+
+        return {"size": len(self.items),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses}
+
+
+def get_cache_stats():
+    """Return the stats of every cache, by name."""
+
+    return dict((name, cache.stats()) for name, cache in all_caches.items())
+
+
+# recipe ids for each page of search results
+search_cache = LRUCache("search", 2048)
+
+# recipe measures packed into arrays for scaling, by recipe id
+packed_cache = LRUCache("packed recipes", 8192)
+
+# rendered recipe pages and their ETags, by recipe, catalog version and user
+page_cache = LRUCache("recipe pages", 1024)
+
+# each user's boxes, saved recipes and notes, by user id and box version
+box_cache = LRUCache("user boxes", 4096)
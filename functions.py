@@ -1,36 +1,54 @@
-from fractions import Fraction
-from model import Ingredient, Course, Recipe
-
-
-def convert_us_amt(ingredient, conversion_amount):
+from flask import current_app
+from sqlalchemy import func, distinct, case, and_, or_, tuple_, bindparam
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import subqueryload
+from model import db, Recipe, Ingredient, Course, RecipeIngredient, RecipeCourse, RecipeBox, RecipeConversion, RecipeServing, Serving
+from model import RecipeDocument, SimilarRecipe, Box, User, IngredientType
+from model import USIngredientMeasure, USAmount, USUnit, MetricIngredientMeasure, MetricAmount, MetricUnit
+from search_index import search_index, TIME_BUCKETS
+from caches import search_cache, packed_cache, box_cache, get_box_version, bump_box_version
+from amounts import format_amount, format_amounts, format_amount_array
+from units import to_base, rescale, rescale_info, choose_units, unit_name
+from itertools import groupby
+import hashlib
+import json
+import numpy as np
+
+# serving sizes offered on the recipe page
+SERVING_SIZES = range(1, 13)
+
+# bumped whenever converted amounts are formatted differently, so stored
+# conversions made by an older formatter are made again, not served
+FORMAT_VERSION = 2
+
+# fields of each kind of recipe box edit, see apply_box_operations
+BOX_OPERATIONS = {"create": ["ref", "label_name"],
+                  "rename": ["box_id", "label_name"],
+                  "notes": ["box_id", "recipe_id", "notes"],
+                  "delete": ["box_id", "recipe_id"],
+                  "move": ["box_id", "recipe_id", "to_box_id"]}
+
+
+def convert_us_amt(measures, conversion_amount):
     """Convert the fractional values of us measurements."""
 
-    amounts = []
-
-    for amount in ingredient.usamounts:
-        new_decimal = float(amount.us_decimal) * conversion_amount
-        whole_num = int(new_decimal)
+    amounts = [float(us_decimal) * conversion_amount for us_decimal in measures['us_amounts']]
+    us_unit = measures['us_units'][0] if measures['us_units'] else None
 
-        if whole_num == 0:
-            new_fraction = str(Fraction(new_decimal).limit_denominator(32))
-        elif (new_decimal - whole_num) == 0.0:
-            new_fraction = str(whole_num)
-        else:
-            if Fraction(new_decimal - whole_num).limit_denominator(32) != 0:
-                new_fraction = str(whole_num) + " " + str(Fraction(new_decimal - whole_num).limit_denominator(32))
-            else:
-                new_fraction = str(whole_num)
+    # scaled amounts are shown in the unit that reads best, e.g. 1 cup not 16 tbsp
+    if conversion_amount != 1:
+        amounts, us_unit = rescale(amounts, us_unit)
 
-        amounts.append(new_fraction)
+    amounts = format_amounts(amounts)
 
     if len(amounts) > 1:
         amounts = amounts[0] + " - " + amounts[1]
-        if ingredient.usunits:
-            amounts = amounts + " " + ingredient.usunits[0].us_unit
+        if us_unit:
+            amounts = amounts + " " + us_unit
     else:
         amounts = amounts[0]
-        if ingredient.usunits:
-            amounts = amounts + " " + ingredient.usunits[0].us_unit
+        if us_unit:
+            amounts = amounts + " " + us_unit
 
     return amounts
 
@@ -52,50 +70,69 @@ def convert_us_unit(conversion_amount):
     return amounts
 
 
-def convert_met_amt(ingredient, conversion_amount):
+def convert_met_amt(measures, conversion_amount):
     """Convert the decimal values of metric measurements."""
 
     metrics = []
-    metric_unit = ingredient.metricunits[0].metric_unit
+    amounts = [float(metric_amount) * conversion_amount for metric_amount in measures['metric_amounts']]
+    metric_unit = measures['metric_units'][0] if measures['metric_units'] else None
 
-    for amount in ingredient.metricamounts:
-        new_metric = str("{0:.2f}".format(float(amount.metric_amount) * conversion_amount))
+    if conversion_amount != 1:
+        amounts, metric_unit = rescale(amounts, metric_unit)
+
+    for metric_amount in amounts:
+        new_metric = str("{0:.2f}".format(metric_amount))
 
         metrics.append(new_metric)
 
     if len(metrics) > 1:
-        metrics = "(" + metrics[0] + " - " + metrics[1] + " " + metric_unit + ")"
+        metrics = metrics[0] + " - " + metrics[1]
     else:
-        metrics = "(" + metrics[0] + " " + metric_unit + ")"
+        metrics = metrics[0]
+
+    # like US amounts, amounts without a unit are shown alone
+    if metric_unit:
+        metrics = metrics + " " + metric_unit
+
+    metrics = "(" + metrics + ")"
 
     return metrics
 
 
-def convert_ingredients(recipe, conversion_amount):
-    """Return converted ingredient measurements."""
+def ingredient_measures(ingredient):
+    """Return the flat measures of a RecipeIngredient, for conversion."""
+
+    return {'original_string': ingredient.original_string,
+            'link': ingredient.link,
+            'us_amounts': [amount.us_decimal for amount in ingredient.usamounts],
+            'us_units': [unit.us_unit for unit in ingredient.usunits],
+            'metric_amounts': [amount.metric_amount for amount in ingredient.metricamounts],
+            'metric_units': [unit.metric_unit for unit in ingredient.metricunits]}
 
-    all_ingredients = []
 
-    for i in range(len(recipe.recipesingredients)):
+def convert_measures(all_measures, conversion_amount):
+    """Return converted measurements of a recipe's flat ingredient measures."""
 
-        ingredient = recipe.recipesingredients[i]
+    all_ingredients = []
+
+    for measures in all_measures:
         ingredient_info = {}
 
-        if ingredient.usamounts:
-            amounts = convert_us_amt(ingredient, conversion_amount)
+        if measures['us_amounts']:
+            amounts = convert_us_amt(measures, conversion_amount)
             ingredient_info['us_amount'] = amounts
-        elif ingredient.usunits and not ingredient.usamounts:
+        elif measures['us_units'] and not measures['us_amounts']:
             amounts = convert_us_unit(conversion_amount)
             ingredient_info['us_amount'] = amounts
 
-        if ingredient.metricamounts:
-            metrics = convert_met_amt(ingredient, conversion_amount)
+        if measures['metric_amounts']:
+            metrics = convert_met_amt(measures, conversion_amount)
             ingredient_info['metric_amount'] = metrics
 
-        ingredient_info['ingredient'] = ingredient.original_string
+        ingredient_info['ingredient'] = measures['original_string']
 
-        if ingredient.link:
-            ingredient_info['extlink'] = ingredient.link
+        if measures['link']:
+            ingredient_info['extlink'] = measures['link']
         else:
             ingredient_info['extlink'] = None
 
@@ -104,99 +141,1052 @@ def convert_ingredients(recipe, conversion_amount):
     return all_ingredients
 
 
-def get_my_recipes_data(boxes):
-    """Return saved recipes, labels as list of dictionaries, for d3 visual."""
+def amount_template(amounts):
+    """Return the format string an ingredient's scaled amounts go into."""
+
+    return "%s - %s" if len(amounts) > 1 else "%s"
+
+
+def pack_amounts(all_measures, amounts_key, units_key):
+    """Return arrays of one kind of amounts of a recipe's flat measures.
+
+    Along with every amount go the dimension and size of its unit, for
+    rescale, and the index of its ingredient's first amount, which picks
+    the unit the ingredient's amounts are shown in.
+    """
+
+    amounts = []
+    dimensions = []
+    sizes = []
+    firsts = []
+
+    for measures in all_measures:
+        unit = measures[units_key][0] if measures[units_key] else None
+        dimension, size = rescale_info(unit)
+        first = len(amounts)
+
+        for amount in measures[amounts_key]:
+            amounts.append(float(amount))
+            dimensions.append(dimension)
+            sizes.append(size)
+            firsts.append(first)
+
+    return {'amounts': np.array(amounts),
+            'dimensions': np.array(dimensions, dtype=object),
+            'sizes': np.array(sizes),
+            'firsts': np.array(firsts, dtype=int)}
+
+
+def pack_measures(all_measures, serving_size):
+    """Return a recipe's flat measures with their amounts packed in arrays.
+
+    The US and metric amounts of every ingredient are concatenated, in
+    ingredient order, into one float array each. Each ingredient keeps
+    its unconverted fields, how many amounts it has of each kind, their
+    units and the templates its formatted amounts are put into.
+    """
+
+    ingredients = []
+
+    for measures in all_measures:
+        info = {'ingredient': measures['original_string'],
+                'extlink': measures['link'] or None}
+
+        ingredients.append((info,
+                            len(measures['us_amounts']),
+                            amount_template(measures['us_amounts']),
+                            measures['us_units'][0] if measures['us_units'] else None,
+                            len(measures['metric_amounts']),
+                            amount_template(measures['metric_amounts']),
+                            measures['metric_units'][0] if measures['metric_units'] else None))
+
+    return {'serving_size': serving_size,
+            'ingredients': ingredients,
+            'us_amounts': pack_amounts(all_measures, 'us_amounts', 'us_units'),
+            'metric_amounts': pack_amounts(all_measures, 'metric_amounts', 'metric_units')}
+
+
+def scale_amounts(packed_amounts, conversion_amounts):
+    """Return scaled amounts of many recipes and the units they are shown in.
+
+    Units are None where the amounts keep their stored unit. Gives the
+    same amounts and units as rescale does one ingredient at a time.
+    """
+
+    counts = [len(packed['amounts']) for packed in packed_amounts]
+    offsets = np.cumsum([0] + counts[:-1])
+
+    factors = np.repeat(conversion_amounts, counts)
+    amounts = np.concatenate([packed['amounts'] for packed in packed_amounts] + [np.zeros(0)]) * factors
+    dimensions = np.concatenate([packed['dimensions'] for packed in packed_amounts] + [np.zeros(0, dtype=object)])
+    sizes = np.concatenate([packed['sizes'] for packed in packed_amounts] + [np.zeros(0)])
+    firsts = np.concatenate([packed['firsts'] + offset for packed, offset in zip(packed_amounts, offsets)] + [np.zeros(0, dtype=int)])
+
+    # amounts at the recipe's own serving size keep their stored unit
+    rescaled = (factors != 1) & (dimensions != "")
+    unit_sizes, units = choose_units(amounts[firsts] * sizes[firsts], np.where(rescaled, dimensions, ""))
+    amounts = np.where(rescaled, amounts * sizes / unit_sizes, amounts)
+
+    return amounts, units
+
+
+def scale_packed(packed_recipes, conversion_amounts):
+    """Return the converted ingredients of each packed recipe.
+
+    Every US amount of every recipe is scaled by its recipe's conversion
+    amount in one NumPy multiply, put in the unit that reads best and
+    rounded to fractions in one table search; the metric amounts
+    likewise. Gives the same ingredients as convert_measures.
+    """
+
+    us_amounts, us_units = scale_amounts([packed['us_amounts'] for packed in packed_recipes], conversion_amounts)
+    metric_amounts, metric_units = scale_amounts([packed['metric_amounts'] for packed in packed_recipes], conversion_amounts)
+
+    us_values = us_amounts.tolist()
+    us_amounts = format_amount_array(us_amounts)
+    unique_metrics, inverse = np.unique(metric_amounts, return_inverse=True)
+    metric_amounts = np.array(["%.2f" % metric for metric in unique_metrics.tolist()], dtype=object)[inverse].tolist()
+    us_units = us_units.tolist()
+    metric_units = metric_units.tolist()
+    us_i = 0
+    metric_i = 0
+
+    scaled = []
+
+    for packed, conversion_amount in zip(packed_recipes, conversion_amounts):
+        all_ingredients = []
+
+        for info, us_count, us_template, us_unit, metric_count, metric_template, metric_unit in packed['ingredients']:
+            ingredient_info = dict(info)
+
+            # only the first two amounts, a range, are shown
+            if us_count:
+                amounts = us_template % tuple(us_amounts[us_i:us_i + min(us_count, 2)])
+                if us_units[us_i]:
+                    us_unit = unit_name(us_units[us_i], us_values[us_i:us_i + us_count])
+                if us_unit:
+                    amounts = amounts + " " + us_unit
+                ingredient_info['us_amount'] = amounts
+                us_i += us_count
+            elif us_unit:
+                ingredient_info['us_amount'] = convert_us_unit(conversion_amount)
+
+            if metric_count:
+                metrics = metric_template % tuple(metric_amounts[metric_i:metric_i + min(metric_count, 2)])
+                metric_unit = metric_units[metric_i] or metric_unit
+                if metric_unit:
+                    metrics = metrics + " " + metric_unit
+                ingredient_info['metric_amount'] = "(" + metrics + ")"
+                metric_i += metric_count
+
+            all_ingredients.append(ingredient_info)
+
+        scaled.append(all_ingredients)
+
+    return scaled
+
+
+def convert_ingredients(recipe, conversion_amount):
+    """Return converted ingredient measurements."""
+
+    all_measures = [ingredient_measures(ingredient) for ingredient in recipe.recipesingredients]
+
+    return convert_measures(all_measures, conversion_amount)
+
+
+def load_document_recipe(recipe_id):
+    """Return a recipe with everything build_recipe_document reads loaded."""
+
+    return Recipe.query.options(subqueryload("websites"),
+                                subqueryload("courses"),
+                                subqueryload("instructions"),
+                                subqueryload("servings"),
+                                subqueryload("recipesingredients").subqueryload("usamounts"),
+                                subqueryload("recipesingredients").subqueryload("usunits"),
+                                subqueryload("recipesingredients").subqueryload("metricamounts"),
+                                subqueryload("recipesingredients").subqueryload("metricunits")).get(recipe_id)
+
+
+def document_measures(ingredient):
+    """Return the flat measures of a RecipeIngredient for its recipe document.
+
+    Amounts are floats, to be stored as JSON, with the amounts as shown
+    on the recipe page alongside.
+    """
+
+    measures = ingredient_measures(ingredient)
+
+    measures['us_amounts'] = [float(amount) for amount in measures['us_amounts']]
+    measures['metric_amounts'] = [float(amount) for amount in measures['metric_amounts']]
+    measures['us_strings'] = [amount.us_amount for amount in ingredient.usamounts]
+    measures['metric_strings'] = [str(amount.metric_amount) for amount in ingredient.metricamounts]
+
+    return measures
+
+
+def build_recipe_document(recipe):
+    """Return the denormalized document of a recipe.
+
+    It holds everything the recipe page shows, and the flat measures
+    conversions are made from, so neither needs more than the document.
+    """
+
+    similar = db.session.query(Recipe.recipe_id,
+                               Recipe.recipe_name,
+                               Recipe.img_url).join(SimilarRecipe,
+                                   SimilarRecipe.similar_recipe_id == Recipe.recipe_id).filter(
+                                   SimilarRecipe.recipe_id == recipe.recipe_id).order_by(SimilarRecipe.rank).all()
+
+    return {"recipe_id": recipe.recipe_id,
+            "recipe_name": recipe.recipe_name,
+            "time_in_min": recipe.time_in_min,
+            "src_url": recipe.src_url,
+            "img_url": recipe.img_url,
+            "site_name": recipe.websites.site_name if recipe.websites else None,
+            "courses": [course.course_name for course in recipe.courses],
+            "serving_size": recipe.servings[0].serving_size,
+            "ingredients": [document_measures(ingredient) for ingredient in recipe.recipesingredients],
+            "instructions": sorted([instruction.step_order, instruction.step_instruction]
+                                   for instruction in recipe.instructions),
+            "similar": [{"recipe_id": recipe_id,
+                         "recipe_name": recipe_name,
+                         "img_url": img_url}
+                        for recipe_id, recipe_name, img_url in similar]}
+
+
+def load_recipe_document(recipe_id):
+    """Return the serialized document of a recipe, or None.
+
+    Documents are normally stored at seed time and read with a single
+    primary key lookup; a recipe without one has it stored on first
+    request.
+    """
+
+    stored = db.session.query(RecipeDocument.document).filter_by(recipe_id=recipe_id).first()
+    if stored:
+        return stored.document
+
+    recipe = load_document_recipe(recipe_id)
+    if not recipe:
+        return None
+
+    document = json.dumps(build_recipe_document(recipe), separators=(',', ':'))
+
+    try:
+        db.session.execute(RecipeDocument.__table__.insert(), {"recipe_id": recipe_id, "document": document})
+        db.session.commit()
+    except IntegrityError:
+        # another request stored it first
+        db.session.rollback()
+
+    return document
+
+
+def get_recipe_document(recipe_id):
+    """Return the document of a recipe, or None."""
+
+    document = load_recipe_document(recipe_id)
+
+    return json.loads(document) if document else None
+
+
+def load_recipe_measures(recipe_ids):
+    """Return flat ingredient measures of each recipe, by recipe id.
+
+    Every measure of every recipe is loaded with one outer-joined query.
+    A recipe ingredient with both US and metric measures comes back once
+    per pair of them, so measures are deduplicated by their ids.
+    """
+
+    rows = db.session.query(RecipeIngredient.recipe_id,
+                            RecipeIngredient.recipeingredient_id,
+                            RecipeIngredient.original_string,
+                            RecipeIngredient.link,
+                            USIngredientMeasure.usingmeasure_id,
+                            USAmount.us_decimal,
+                            USUnit.us_unit,
+                            MetricIngredientMeasure.metringmeasure_id,
+                            MetricAmount.metric_amount,
+                            MetricUnit.metric_unit).outerjoin(
+                                USIngredientMeasure,
+                                USIngredientMeasure.recipeingredient_id == RecipeIngredient.recipeingredient_id).outerjoin(
+                                USAmount, USAmount.us_amount_id == USIngredientMeasure.us_amount_id).outerjoin(
+                                USUnit, USUnit.us_unit_id == USIngredientMeasure.us_unit_id).outerjoin(
+                                MetricIngredientMeasure,
+                                MetricIngredientMeasure.recipeingredient_id == RecipeIngredient.recipeingredient_id).outerjoin(
+                                MetricAmount, MetricAmount.metric_amount_id == MetricIngredientMeasure.metric_amount_id).outerjoin(
+                                MetricUnit, MetricUnit.metric_unit_id == MetricIngredientMeasure.metric_unit_id).filter(
+                                RecipeIngredient.recipe_id.in_(recipe_ids)).order_by(
+                                RecipeIngredient.recipeingredient_id,
+                                USIngredientMeasure.usingmeasure_id,
+                                MetricIngredientMeasure.metringmeasure_id).all()
+
+    recipes = dict((recipe_id, []) for recipe_id in recipe_ids)
+    measures = None
+    seen = set()
+
+    for row in rows:
+        if measures is None or measures['recipeingredient_id'] != row.recipeingredient_id:
+            measures = {'recipeingredient_id': row.recipeingredient_id,
+                        'original_string': row.original_string,
+                        'link': row.link,
+                        'us_amounts': [],
+                        'us_units': [],
+                        'metric_amounts': [],
+                        'metric_units': []}
+            recipes[row.recipe_id].append(measures)
+            seen = set()
+
+        if row.usingmeasure_id is not None and ('us', row.usingmeasure_id) not in seen:
+            seen.add(('us', row.usingmeasure_id))
+            if row.us_decimal is not None:
+                measures['us_amounts'].append(row.us_decimal)
+            if row.us_unit is not None:
+                measures['us_units'].append(row.us_unit)
+
+        if row.metringmeasure_id is not None and ('metric', row.metringmeasure_id) not in seen:
+            seen.add(('metric', row.metringmeasure_id))
+            if row.metric_amount is not None:
+                measures['metric_amounts'].append(row.metric_amount)
+            if row.metric_unit is not None:
+                measures['metric_units'].append(row.metric_unit)
+
+    return recipes
+
+
+def load_packed_recipes(recipe_ids):
+    """Return the packed measures of each known recipe, by recipe id.
+
+    Packed recipes are cached until the catalog changes. Recipes not in
+    the cache are loaded together, with one query for their measures and
+    one for their original serving sizes.
+    """
+
+    packed_recipes = {}
+    missing = []
+
+    for recipe_id in recipe_ids:
+        packed = packed_cache.get(recipe_id)
+        if packed is None:
+            missing.append(recipe_id)
+        else:
+            packed_recipes[recipe_id] = packed
+
+    if not missing:
+        return packed_recipes
+
+    orig_servings = dict(db.session.query(RecipeServing.recipe_id,
+                                          Serving.serving_size).join(
+                                              Serving, Serving.serving_id == RecipeServing.serving_id).filter(
+                                              RecipeServing.recipe_id.in_(missing)).all())
+
+    if orig_servings:
+        recipe_measures = load_recipe_measures(orig_servings.keys())
+
+        for recipe_id, serving_size in orig_servings.items():
+            packed_recipes[recipe_id] = pack_measures(recipe_measures[recipe_id], serving_size)
+            packed_cache.set(recipe_id, packed_recipes[recipe_id])
+
+    return packed_recipes
+
+
+def scale_recipes(servings):
+    """Return the converted ingredients of many recipes at once.
+
+    servings is a list of (recipe_id, serving size) pairs; a recipe may
+    appear more than once. All the recipes are scaled together from their
+    packed measures. Unknown recipe ids are skipped.
+    """
+
+    packed_recipes = load_packed_recipes(set(recipe_id for recipe_id, serving_size in servings))
+
+    servings = [(recipe_id, serving_size) for recipe_id, serving_size in servings if recipe_id in packed_recipes]
+
+    all_ingredients = scale_packed([packed_recipes[recipe_id] for recipe_id, serving_size in servings],
+                                   [float(serving_size) / packed_recipes[recipe_id]['serving_size']
+                                    for recipe_id, serving_size in servings])
+
+    return [{"recipe_id": recipe_id,
+             "serving": serving_size,
+             "ingredients": ingredients}
+            for (recipe_id, serving_size), ingredients in zip(servings, all_ingredients)]
+
+
+def amount_payload(document):
+    """Return a recipe document's amounts at every offered serving size, for recipe.js.
+
+    The amounts are formatted here, by scale_document, so the browser
+    only swaps in [US amount, metric amount] strings (None where the
+    cell is left as it is), in the order of the page's ingredient table.
+    """
+
+    servings = {}
+
+    for serving_size, ingredients in scale_document(document):
+        servings[serving_size] = [[ingredient.get('us_amount'), ingredient.get('metric_amount')]
+                                  for ingredient in ingredients]
+
+    return {"serving": document['serving_size'],
+            "servings": servings}
+
+
+def shopping_list_query(box_ids):
+    """Return the query of every US and metric measure of the recipes in boxes.
+
+    One row per measure, with its recipe's serving size, sorted so each
+    ingredient's rows, and each recipe ingredient's within them, are
+    together. A recipe in several of the boxes is only counted once, and
+    a recipe with several servings is scaled from its first.
+    """
+
+    recipe_ids = db.session.query(distinct(RecipeBox.recipe_id)).filter(RecipeBox.box_id.in_(box_ids))
+
+    recipe_servings = db.session.query(RecipeServing.recipe_id,
+                                       func.min(RecipeServing.serving_id).label("serving_id")).filter(
+                                           RecipeServing.recipe_id.in_(recipe_ids)).group_by(
+                                           RecipeServing.recipe_id).subquery()
+
+    return db.session.query(Ingredient.ingredient_id,
+                            Ingredient.ingredient_name,
+                            RecipeIngredient.recipe_id,
+                            RecipeIngredient.recipeingredient_id,
+                            Serving.serving_size,
+                            USAmount.us_decimal,
+                            USUnit.us_unit,
+                            MetricAmount.metric_amount,
+                            MetricUnit.metric_unit).join(
+                                RecipeIngredient, RecipeIngredient.ingredient_id == Ingredient.ingredient_id).join(
+                                recipe_servings, recipe_servings.c.recipe_id == RecipeIngredient.recipe_id).join(
+                                Serving, Serving.serving_id == recipe_servings.c.serving_id).outerjoin(
+                                USIngredientMeasure, USIngredientMeasure.recipeingredient_id == RecipeIngredient.recipeingredient_id).outerjoin(
+                                USAmount, USAmount.us_amount_id == USIngredientMeasure.us_amount_id).outerjoin(
+                                USUnit, USUnit.us_unit_id == USIngredientMeasure.us_unit_id).outerjoin(
+                                MetricIngredientMeasure, MetricIngredientMeasure.recipeingredient_id == RecipeIngredient.recipeingredient_id).outerjoin(
+                                MetricAmount, MetricAmount.metric_amount_id == MetricIngredientMeasure.metric_amount_id).outerjoin(
+                                MetricUnit, MetricUnit.metric_unit_id == MetricIngredientMeasure.metric_unit_id).order_by(
+                                Ingredient.ingredient_name,
+                                Ingredient.ingredient_id,
+                                RecipeIngredient.recipeingredient_id,
+                                USIngredientMeasure.usingmeasure_id,
+                                MetricIngredientMeasure.metringmeasure_id)
+
+
+def reduce_shopping_list(rows, serving_size=None):
+    """Yield the shopping list items of sorted shopping list rows.
+
+    Rows are reduced one ingredient at a time, so only one ingredient's
+    totals are held at once. Each recipe's amount, the top of a range, is
+    scaled to serving_size, if given, and summed in its unit's base unit.
+    """
+
+    for (ingredient_id, ingredient_name), ingredient_rows in groupby(rows, key=lambda row: (row.ingredient_id, row.ingredient_name)):
+        recipe_ids = set()
+        totals = {}
+
+        for recipeingredient_id, measure_rows in groupby(ingredient_rows, key=lambda row: row.recipeingredient_id):
+            us_amounts = []
+            us_unit = None
+            metric_amounts = []
+            metric_unit = None
+
+            for row in measure_rows:
+                if row.us_decimal is not None:
+                    us_amounts.append(float(row.us_decimal))
+                if us_unit is None:
+                    us_unit = row.us_unit
+                if row.metric_amount is not None:
+                    metric_amounts.append(float(row.metric_amount))
+                if metric_unit is None:
+                    metric_unit = row.metric_unit
+
+            recipe_ids.add(row.recipe_id)
+
+            # ingredients measured only in metric are totaled in metric
+            if us_amounts:
+                amounts, unit = us_amounts, us_unit
+            elif metric_amounts:
+                amounts, unit = metric_amounts, metric_unit
+            else:
+                continue
+
+            amount = max(amounts)
+            if serving_size:
+                amount = amount * serving_size / float(row.serving_size)
+
+            # units without display units, like cloves, are summed as they are
+            if rescale_info(unit)[0]:
+                amount, unit = to_base(amount, unit)
 
-    data = [{"name": "My Recipes", "parent": None, "value": 6, "img": "/static/img/my_rec_icon.jpg"}]
+            totals[unit] = totals.get(unit, 0) + amount
 
-    for box in boxes:
-        each_box = dict(zip(["name", "parent", "value", "img"], [box.label_name, "My Recipes", 4, "/static/img/leaf0.png"]))
-        data.append(each_box)
-        for recipe in box.recipes:
-            each_recipe = dict(zip(["name", "parent", "value", "img", "url"], [recipe.recipe_name, box.label_name, 3.5, recipe.img_url, "/recipe/" + str(recipe.recipe_id)]))
-            data.append(each_recipe)
+        shopping_amounts = []
+
+        for unit, total in sorted(totals.items()):
+            amounts, unit = rescale([total], unit)
+            shopping_amounts.append(format_amount(amounts[0]) + (" " + unit if unit else ""))
+
+        yield {"ingredient": ingredient_name,
+               "recipes": len(recipe_ids),
+               "amounts": shopping_amounts}
+
+
+def serialize_conversion(ingredients):
+    """Return (conversion JSON, ETag) of converted ingredients.
+
+    The ETag is a hash of the JSON, so it only changes with the content.
+    """
+
+    conversion = json.dumps(ingredients, separators=(',', ':'))
+
+    return conversion, hashlib.sha1(conversion).hexdigest()
+
+
+def scale_document(document):
+    """Return (serving size, converted ingredients) of a recipe document for every offered serving size.
+
+    All of them are scaled at once from the recipe's packed measures.
+    """
+
+    orig_serving = document['serving_size']
+    packed = pack_measures(document['ingredients'], orig_serving)
+
+    all_ingredients = scale_packed([packed] * len(SERVING_SIZES),
+                                   [float(serving_size) / orig_serving for serving_size in SERVING_SIZES])
+
+    return zip(SERVING_SIZES, all_ingredients)
+
+
+def build_recipe_conversions(document):
+    """Return conversion rows of a recipe document for every offered serving size."""
+
+    rows = []
+
+    for serving_size, ingredients in scale_document(document):
+        conversion, etag = serialize_conversion(ingredients)
+        rows.append({"recipe_id": document['recipe_id'],
+                     "serving_size": serving_size,
+                     "format_version": FORMAT_VERSION,
+                     "conversion": conversion,
+                     "etag": etag})
+
+    return rows
+
+
+def get_recipe_conversion(recipe_id, serving_size):
+    """Return (conversion JSON, ETag) of a recipe for a serving size, or None.
+
+    Conversions are normally stored at seed time; a recipe without them,
+    or with only ones made by an older formatter, has all of its
+    conversions made from its document and stored on first request. Serving sizes the recipe page does not offer are converted
+    without being stored.
+    """
+
+    if serving_size in SERVING_SIZES:
+        stored = db.session.query(RecipeConversion.conversion,
+                                  RecipeConversion.etag).filter_by(recipe_id=recipe_id,
+                                                                   serving_size=serving_size,
+                                                                   format_version=FORMAT_VERSION).first()
+        if stored:
+            return stored
+
+    document = get_recipe_document(recipe_id)
+    if not document:
+        return None
+
+    if serving_size not in SERVING_SIZES:
+        conversion_amount = float(serving_size) / document['serving_size']
+        return serialize_conversion(convert_measures(document['ingredients'], conversion_amount))
+
+    rows = build_recipe_conversions(document)
+
+    try:
+        db.session.execute(RecipeConversion.__table__.insert(), rows)
+        db.session.commit()
+    except IntegrityError:
+        # another request stored them first
+        db.session.rollback()
+
+    row = rows[SERVING_SIZES.index(serving_size)]
+
+    return row["conversion"], row["etag"]
+
+
+def load_user_boxes(user_id):
+    """Return a user and their boxes, saved recipes and notes.
+
+    One query joins the user to their boxes and the boxes to their
+    recipes, keeping boxes without any. Boxes are in the order they were
+    made, and recipes in the order they were saved. A user who is not in
+    the database, like one left in a session from before a reseed, has
+    no boxes and a user of None.
+    """
+
+    rows = db.session.query(User.user_id,
+                            User.username,
+                            User.profile_img,
+                            Box.box_id,
+                            Box.label_name,
+                            RecipeBox.recipebox_id,
+                            RecipeBox.recipe_notes,
+                            Recipe.recipe_id,
+                            Recipe.recipe_name,
+                            Recipe.img_url).outerjoin(
+                                Box, Box.user_id == User.user_id).outerjoin(
+                                RecipeBox, RecipeBox.box_id == Box.box_id).outerjoin(
+                                Recipe, Recipe.recipe_id == RecipeBox.recipe_id).filter(
+                                User.user_id == user_id).order_by(
+                                Box.box_id, RecipeBox.recipebox_id).all()
+
+    if not rows:
+        return {"user": None, "boxes": []}
+
+    user = {"user_id": rows[0].user_id,
+            "username": rows[0].username,
+            "profile_img": rows[0].profile_img}
+    boxes = []
+
+    for row in rows:
+        if row.box_id is None:
+            continue
+
+        if not boxes or boxes[-1]["box_id"] != row.box_id:
+            boxes.append({"box_id": row.box_id,
+                          "label_name": row.label_name,
+                          "recipes": []})
+
+        if row.recipe_id is not None:
+            boxes[-1]["recipes"].append({"recipebox_id": row.recipebox_id,
+                                         "recipe_id": row.recipe_id,
+                                         "recipe_name": row.recipe_name,
+                                         "img_url": row.img_url,
+                                         "recipe_notes": row.recipe_notes})
+
+    return {"user": user, "boxes": boxes}
+
+
+def get_user_boxes(user_id):
+    """Return load_user_boxes of a user, cached until their boxes change.
+
+    Every change to a user, their boxes or saved recipes must call
+    caches.bump_box_version before it is committed, so the version the
+    cached copy is keyed by changes with it in every process.
+    """
+
+    key = (user_id, get_box_version(user_id))
+
+    user_boxes = box_cache.get(key)
+    if user_boxes is None:
+        user_boxes = load_user_boxes(user_id)
+        # a user not in the database yet may be added at the same box version
+        if user_boxes["user"] is not None:
+            box_cache.set(key, user_boxes)
+
+    return user_boxes
+
+
+def check_box_operations(operations):
+    """Return the box ids a list of box edits refers to, or None if invalid.
+
+    Each edit is a dict with an "op" from BOX_OPERATIONS and its fields.
+    A move may go to a box created in the same batch, by its "ref".
+    """
+
+    box_ids = set()
+    refs = set(operation.get("ref") for operation in operations
+               if isinstance(operation, dict) and operation.get("op") == "create")
+
+    for operation in operations:
+        if not isinstance(operation, dict) or operation.get("op") not in BOX_OPERATIONS:
+            return None
+
+        # refs are strings, so they are never mistaken for box ids
+        if operation["op"] == "create" and not isinstance(operation.get("ref"), basestring):
+            return None
+
+        for field in BOX_OPERATIONS[operation["op"]]:
+            if field not in operation:
+                return None
+
+        # bools are ints too, but never ids
+        for field in ["box_id", "recipe_id"]:
+            if field in operation and (not isinstance(operation[field], int) or isinstance(operation[field], bool)):
+                return None
+
+        for field in ["label_name", "notes"]:
+            if field in operation and not isinstance(operation[field], basestring):
+                return None
+
+        if "box_id" in operation:
+            box_ids.add(operation["box_id"])
+
+        to_box_id = operation.get("to_box_id")
+        if isinstance(to_box_id, int) and not isinstance(to_box_id, bool):
+            box_ids.add(to_box_id)
+        elif "to_box_id" in operation and to_box_id not in refs:
+            return None
+
+    return box_ids
+
+
+def apply_box_operations(user_id, operations):
+    """Apply checked box edits of a user in one transaction.
+
+    Each kind of edit is one bulk statement: boxes are created, renamed,
+    notes edited, recipes deleted and then moved, in that order. Recipes
+    are addressed by the box they are in before the batch. Returns the
+    new box ids by ref, and bumps the user's box version in the same
+    transaction. Raises ValueError, changing nothing, if a recipe
+    would be moved to a box already holding it, or a recipe edited,
+    deleted or moved is not in the box given.
+    """
+
+    by_op = dict((op, [operation for operation in operations if operation["op"] == op])
+                 for op in BOX_OPERATIONS)
+
+    moves = by_op["move"]
+    if moves:
+        pairs = [(operation["to_box_id"], operation["recipe_id"]) for operation in moves
+                 if isinstance(operation["to_box_id"], int)]
+        if len(set((operation["to_box_id"], operation["recipe_id"]) for operation in moves)) < len(moves) or (
+                pairs and RecipeBox.query.filter(tuple_(RecipeBox.box_id, RecipeBox.recipe_id).in_(pairs)).count()):
+            raise ValueError("recipe already in box")
+
+    created = {}
+
+    try:
+        for operation in by_op["create"]:
+            created[operation["ref"]] = db.session.execute(
+                Box.__table__.insert(),
+                {"user_id": user_id, "label_name": operation["label_name"]}).inserted_primary_key[0]
+
+        if by_op["rename"]:
+            db.session.execute(Box.__table__.update().where(
+                                   Box.box_id == bindparam("b_box_id")).values(
+                                   label_name=bindparam("b_label_name")),
+                               [{"b_box_id": operation["box_id"], "b_label_name": operation["label_name"]}
+                                for operation in by_op["rename"]])
+
+        if by_op["notes"]:
+            updated = db.session.execute(RecipeBox.__table__.update().where(and_(
+                                             RecipeBox.box_id == bindparam("b_box_id"),
+                                             RecipeBox.recipe_id == bindparam("b_recipe_id"))).values(
+                                             recipe_notes=bindparam("b_notes")),
+                                         [{"b_box_id": operation["box_id"],
+                                           "b_recipe_id": operation["recipe_id"],
+                                           "b_notes": operation["notes"]}
+                                          for operation in by_op["notes"]]).rowcount
+            if updated != len(by_op["notes"]):
+                raise ValueError("recipe not in box")
+
+        if by_op["delete"]:
+            deleted = db.session.execute(RecipeBox.__table__.delete().where(
+                tuple_(RecipeBox.box_id, RecipeBox.recipe_id).in_(
+                    [(operation["box_id"], operation["recipe_id"]) for operation in by_op["delete"]]))).rowcount
+            if deleted != len(by_op["delete"]):
+                raise ValueError("recipe not in box")
+
+        if moves:
+            moved = db.session.execute(RecipeBox.__table__.update().where(and_(
+                                           RecipeBox.box_id == bindparam("b_box_id"),
+                                           RecipeBox.recipe_id == bindparam("b_recipe_id"))).values(
+                                           box_id=bindparam("b_to_box_id")),
+                                       [{"b_box_id": operation["box_id"],
+                                         "b_recipe_id": operation["recipe_id"],
+                                         "b_to_box_id": created.get(operation["to_box_id"], operation["to_box_id"])}
+                                        for operation in moves]).rowcount
+            if moved != len(moves):
+                raise ValueError("recipe not in box")
+
+        bump_box_version(user_id)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return created
+
+
+def get_my_recipes_data(user_id):
+    """Return a user's labels and saved recipes in d3 stratify format.
+
+    Every node has its own id, so a recipe saved under two labels, or
+    named like a label, is still a node of its own.
+    """
+
+    data = [{"id": "root", "name": "My Recipes", "parent": None, "value": 6, "img": "/static/img/my_rec_icon.jpg"}]
+
+    for box in get_user_boxes(user_id)["boxes"]:
+        data.append({"id": "box%d" % box["box_id"],
+                     "name": box["label_name"],
+                     "parent": "root",
+                     "value": 4,
+                     "img": "/static/img/leaf0.png"})
+
+        for recipe in box["recipes"]:
+            data.append({"id": "recipebox%d" % recipe["recipebox_id"],
+                         "name": recipe["recipe_name"],
+                         "parent": "box%d" % box["box_id"],
+                         "value": 3.5,
+                         "img": recipe["img_url"],
+                         "url": "/recipe/%d" % recipe["recipe_id"]})
 
-    print data
     return data
 
 
-def match_ingredients(ingredients, search_term):
-    """Return list of recipes taht match the list of ingredients given."""
+def get_box_counts(user_id):
+    """Return the id, label and number of saved recipes of a user's boxes.
 
-    recipe_count = {}
+    One grouped query, cached like get_user_boxes, so a user with
+    thousands of saved recipes only counts them.
+    """
 
-    find_ingredients = Ingredient.query.filter(Ingredient.ingredient_name.in_(ingredients)).all()
+    key = ("counts", user_id, get_box_version(user_id))
 
-    for ingredient in find_ingredients:
-        find_recipes = ingredient.recipes
-        for recipe in find_recipes:
-            recipe_count[recipe] = recipe_count.get(recipe, 0) + 1
+    counts = box_cache.get(key)
+    if counts is None:
+        rows = db.session.query(Box.box_id,
+                                Box.label_name,
+                                func.count(RecipeBox.recipebox_id)).outerjoin(
+                                    RecipeBox, RecipeBox.box_id == Box.box_id).filter(
+                                    Box.user_id == user_id).group_by(
+                                    Box.box_id, Box.label_name).order_by(Box.box_id).all()
+        counts = [{"box_id": box_id, "label_name": label_name, "count": count}
+                  for box_id, label_name, count in rows]
+        box_cache.set(key, counts)
 
-    if search_term == "all":
-        for item, count in recipe_count.items():
-            if count != len(ingredients):
-                del recipe_count[item]
+    return counts
 
-    return recipe_count.keys()
 
+def get_my_recipes_boxes(user_id):
+    """Return the root and label nodes of get_my_recipes_data, without recipes.
 
-def match_courses(courses, search_term):
-    """Return list of recipes that match the list of courses given."""
+    Each label node has its box_id and the count of recipes in it, which
+    get_box_page fetches when the label is opened.
+    """
 
-    find_courses = Course.query.filter(Course.course_name.in_(courses)).all()
+    data = [{"id": "root", "name": "My Recipes", "parent": None, "value": 6, "img": "/static/img/my_rec_icon.jpg"}]
 
-    course_count = {}
+    for box in get_box_counts(user_id):
+        data.append({"id": "box%d" % box["box_id"],
+                     "name": box["label_name"],
+                     "parent": "root",
+                     "value": 4,
+                     "img": "/static/img/leaf0.png",
+                     "box_id": box["box_id"],
+                     "count": box["count"]})
 
-    for course in find_courses:
-        find_courses = course.recipes
-        for recipe in find_courses:
-            course_count[recipe] = course_count.get(recipe, 0) + 1
+    return data
 
-    if search_term == "all":
-        for item, count in course_count.items():
-            if count != len(courses):
-                del course_count[item]
 
-    return course_count.keys()
+def get_box_page(box_id, after=None, limit=24):
+    """Return a page of a box's recipe nodes, in the order they were saved.
 
+    Pages are keyed by the last recipebox_id seen, so each page is one
+    index range scan however deep it is. Returns {"nodes", "after"},
+    where after is None on the last page.
+    """
 
-def match_time(time):
-    """Return list of recipes that are under the maximum time given."""
+    query = db.session.query(RecipeBox.recipebox_id,
+                             Recipe.recipe_id,
+                             Recipe.recipe_name,
+                             Recipe.img_url).join(
+                                 Recipe, Recipe.recipe_id == RecipeBox.recipe_id).filter(
+                                 RecipeBox.box_id == box_id)
 
-    find_time = Recipe.query.filter(Recipe.time_in_min < int(time)).all()
+    if after is not None:
+        query = query.filter(RecipeBox.recipebox_id > after)
 
-    time_count = {}
+    # one extra row tells whether there is another page
+    rows = query.order_by(RecipeBox.recipebox_id).limit(limit + 1).all()
 
-    for recipe in find_time:
-        time_count[recipe] = time_count.get(recipe, 0) + 1
+    nodes = [{"id": "recipebox%d" % row.recipebox_id,
+              "name": row.recipe_name,
+              "parent": "box%d" % box_id,
+              "value": 3.5,
+              "img": row.img_url,
+              "url": "/recipe/%d" % row.recipe_id} for row in rows[:limit]]
 
-    return time_count.keys()
+    return {"nodes": nodes,
+            "after": rows[limit - 1].recipebox_id if len(rows) > limit else None}
 
 
-def find_matching_recipes(search_term, ingredients, courses, time):
-    """Return list of recipes that match the search parameters."""
+def build_search_query(search_term, ingredients, courses, time, missing=0):
+    """Return a single query for the recipes that match the search parameters.
 
-    find_ingredients = set()
-    find_courses = set()
-    find_time = set()
+    Only the columns needed to list a recipe are selected. "all" searches
+    keep recipes whose distinct matched ingredients (or courses) cover every
+    term, using GROUP BY/HAVING COUNT. "pantry" searches keep recipes with
+    at most missing ingredients outside the ones given.
+    """
 
-    if not ingredients and not courses and not time:
-        recipes = Recipe.query.all()
+    query = db.session.query(Recipe.recipe_id, Recipe.recipe_name, Recipe.img_url)
 
-        return recipes
+    filters = []
 
-    if ingredients:
-        find_ingredients = set(match_ingredients(ingredients, search_term))
+    if search_term == "pantry":
+        outside = case([(Ingredient.ingredient_name.in_(ingredients or [u""]), None)],
+                       else_=Ingredient.ingredient_id)
+        matches = db.session.query(RecipeIngredient.recipe_id).join(Ingredient,
+            RecipeIngredient.ingredient_id == Ingredient.ingredient_id).group_by(
+            RecipeIngredient.recipe_id).having(func.count(distinct(outside)) <= missing)
+        filters.append(Recipe.recipe_id.in_(matches.subquery()))
+    elif ingredients:
+        matches = db.session.query(RecipeIngredient.recipe_id).join(Ingredient,
+            RecipeIngredient.ingredient_id == Ingredient.ingredient_id).filter(
+            Ingredient.ingredient_name.in_(ingredients)).group_by(RecipeIngredient.recipe_id)
+        if search_term == "all":
+            matches = matches.having(func.count(distinct(Ingredient.ingredient_name)) == len(set(ingredients)))
+        filters.append(Recipe.recipe_id.in_(matches.subquery()))
 
     if courses:
-        find_courses = set(match_courses(courses, search_term))
+        matches = db.session.query(RecipeCourse.recipe_id).join(Course,
+            RecipeCourse.course_id == Course.course_id).filter(
+            Course.course_name.in_(courses)).group_by(RecipeCourse.recipe_id)
+        if search_term == "all":
+            matches = matches.having(func.count(distinct(Course.course_name)) == len(set(courses)))
+        filters.append(Recipe.recipe_id.in_(matches.subquery()))
 
     if time:
-        find_time = set(match_time(time))
+        filters.append(Recipe.time_in_min < int(time))
+
+    if filters and search_term == "any":
+        query = query.filter(or_(*filters))
+    elif filters:
+        query = query.filter(and_(*filters))
+
+    return query.order_by(Recipe.recipe_name, Recipe.recipe_id)
+
 
-    if search_term == "any":
-        recipes = find_ingredients | find_courses | find_time
+def search_key(search_term, ingredients, courses, time, missing, after, limit):
+    """Return a canonical cache key for a page of search results."""
+
+    ingredients = tuple(sorted(set(ingredients or [])))
+    courses = tuple(sorted(set(courses or [])))
+    time = int(time) if time else None
+
+    # any/all makes no difference without filters
+    if search_term != "pantry" and not ingredients and not courses and not time:
+        search_term = None
+
+    if search_term != "pantry":
+        missing = None
+
+    return (search_term, ingredients, courses, time, missing, after, limit)
+
+
+def load_search_results(recipe_ids):
+    """Return the columns needed to list the recipes, ordered by name."""
+
+    if not recipe_ids:
+        return []
+
+    recipes = db.session.query(Recipe.recipe_id,
+                               Recipe.recipe_name,
+                               Recipe.img_url).filter(Recipe.recipe_id.in_(recipe_ids)).order_by(Recipe.recipe_name,
+                                                                                                 Recipe.recipe_id).all()
+
+    return recipes
+
+
+def find_matching_recipes(search_term, ingredients, courses, time, missing=0, after=None, limit=None):
+    """Return list of recipes that match the search parameters.
+
+    Recipes are ordered by name. after is the recipe id of the last recipe
+    on the previous page and limit is the page size, so results are read a
+    page at a time instead of loading the whole catalog. The recipe ids of
+    each page are cached until the catalog changes.
+
+    Matching uses the in-memory search index unless the app is configured
+    with SEARCH_INDEX = False, in which case the whole search runs as one
+    SQL statement.
+    """
+
+    use_index = current_app.config.get('SEARCH_INDEX', True)
+
+    # pages from the index and from SQL are cached apart
+    key = search_key(search_term, ingredients, courses, time, missing, after, limit) + (use_index,)
+    recipe_ids = search_cache.get(key)
+
+    if recipe_ids is not None:
+        return load_search_results(recipe_ids)
+
+    if not use_index:
+        query = build_search_query(search_term, ingredients, courses, time, missing)
+
+        if after:
+            # keyset pagination on (recipe_name, recipe_id)
+            after_name = db.session.query(Recipe.recipe_name).filter(Recipe.recipe_id == after).as_scalar()
+            query = query.filter(or_(Recipe.recipe_name > after_name,
+                                     and_(Recipe.recipe_name == after_name,
+                                          Recipe.recipe_id > after)))
+
+        recipes = query.limit(limit).all()
     else:
-        recipes = find_ingredients & find_courses & find_time
+        bitmap = search_index.match(search_term, ingredients, courses, time, missing)
+        recipes = load_search_results(search_index.recipe_ids_for(bitmap, after=after, limit=limit))
+
+    search_cache.set(key, tuple(recipe.recipe_id for recipe in recipes))
 
     return recipes
+
+
+def rank_matching_recipes(ingredients, courses, time, k):
+    """Return the top k recipes by ingredient and course coverage."""
+
+    key = search_key("ranked", ingredients, courses, time, None, None, k)
+    recipe_ids = search_cache.get(key)
+
+    if recipe_ids is None:
+        recipe_ids = tuple(search_index.rank(ingredients, courses, time=time, k=k))
+        search_cache.set(key, recipe_ids)
+
+    recipes = dict((recipe.recipe_id, recipe) for recipe in load_search_results(recipe_ids))
+
+    return [recipes[recipe_id] for recipe_id in recipe_ids if recipe_id in recipes]
+
+
+def count_matching_recipes(search_term, ingredients, courses, time, missing=0):
+    """Return facet counts for every recipe that matches the search.
+
+    Like find_matching_recipes, the counts come from the search index
+    unless SEARCH_INDEX is False, when they are grouped counts over the
+    same SQL the results come from.
+    """
+
+    if not current_app.config.get('SEARCH_INDEX', True):
+        return count_search_query(build_search_query(search_term, ingredients, courses, time, missing))
+
+    bitmap = search_index.match(search_term, ingredients, courses, time, missing)
+
+    return search_index.facets(bitmap)
+
+
+def count_search_query(query):
+    """Return the facets of search_index.facets for the recipes of a search query.
+
+    One query counts the total and each time bucket, and one each the
+    courses and ingredient types.
+    """
+
+    matches = query.with_entities(Recipe.recipe_id).order_by(None).subquery()
+
+    counts = db.session.query(func.count(Recipe.recipe_id),
+                              *[func.count(case([(Recipe.time_in_min < minutes, 1)]))
+                                for minutes in TIME_BUCKETS]).filter(
+                                Recipe.recipe_id.in_(matches)).one()
+
+    courses = db.session.query(Course.course_name,
+                               func.count(distinct(RecipeCourse.recipe_id))).join(RecipeCourse,
+        RecipeCourse.course_id == Course.course_id).filter(
+        RecipeCourse.recipe_id.in_(matches)).group_by(Course.course_name).order_by(Course.course_name).all()
+
+    types = db.session.query(IngredientType.type_name,
+                             func.count(distinct(RecipeIngredient.recipe_id))).join(Ingredient,
+        Ingredient.type_id == IngredientType.type_id).join(RecipeIngredient,
+        RecipeIngredient.ingredient_id == Ingredient.ingredient_id).filter(
+        RecipeIngredient.recipe_id.in_(matches)).group_by(IngredientType.type_name).order_by(IngredientType.type_name).all()
+
+    return {"total": counts[0],
+            "courses": [(name, count) for name, count in courses],
+            "types": [(name, count) for name, count in types],
+            "times": zip(TIME_BUCKETS, counts[1:])}
@@ -21,6 +21,8 @@ class User(db.Model):
     username = db.Column(db.String(64), unique=True, nullable=False)
     password = db.Column(db.String(200), nullable=False)
     profile_img = db.Column(db.String(200), nullable=True)
+    # bumped in the same transaction as every change to the user's boxes
+    boxes_version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     def __repr__(self):
         """Provide helpful representation when printed."""
@@ -71,6 +73,7 @@ class Recipe(db.Model):
 
     #Define relationship recipesingredients table
     recipesingredients = db.relationship("RecipeIngredient",
+                                         order_by="RecipeIngredient.recipeingredient_id",
                                          backref=db.backref("recipes"))
 
     #Define relationship instructions table
@@ -196,7 +199,8 @@ class USUnit(db.Model):
     #Define relationship ingredients table
     recipesingredients = db.relationship("RecipeIngredient",
                                          secondary="usingredientsmeasures",
-                                         backref=db.backref("usunits"))
+                                         backref=db.backref("usunits",
+                                                            order_by="USIngredientMeasure.usingmeasure_id"))
 
 
 class MetricUnit(db.Model):
@@ -221,7 +225,8 @@ class MetricUnit(db.Model):
     #Define relationship ingredients table
     recipesingredients = db.relationship("RecipeIngredient",
                                          secondary="metricingredientsmeasures",
-                                         backref=db.backref("metricunits"))
+                                         backref=db.backref("metricunits",
+                                                            order_by="MetricIngredientMeasure.metringmeasure_id"))
 
 
 class USAmount(db.Model):
@@ -249,7 +254,8 @@ class USAmount(db.Model):
     #Define relationship ingredients table
     recipesingredients = db.relationship("RecipeIngredient",
                                   secondary="usingredientsmeasures",
-                                  backref=db.backref("usamounts"))
+                                  backref=db.backref("usamounts",
+                                                     order_by="USIngredientMeasure.usingmeasure_id"))
 
 
 class MetricAmount(db.Model):
@@ -274,7 +280,8 @@ class MetricAmount(db.Model):
     #Define relationship ingredients table
     recipesingredients = db.relationship("RecipeIngredient",
                                   secondary="metricingredientsmeasures",
-                                  backref=db.backref("metricamounts"))
+                                  backref=db.backref("metricamounts",
+                                                     order_by="MetricIngredientMeasure.metringmeasure_id"))
 
 
 class Instruction(db.Model):
@@ -471,6 +478,89 @@ class RecipeCourse(db.Model):
                                                              self.course_id)
 
 
+class SimilarRecipe(db.Model):
+    """Precomputed similar recipe, ranked by shared ingredients."""
+
+    __tablename__ = "similarrecipes"
+
+    similarrecipe_id = db.Column(db.Integer,
+                                 autoincrement=True,
+                                 primary_key=True)
+    recipe_id = db.Column(db.Integer,
+                          db.ForeignKey('recipes.recipe_id'),
+                          index=True)
+    similar_recipe_id = db.Column(db.Integer,
+                                  db.ForeignKey('recipes.recipe_id'))
+    rank = db.Column(db.Integer, nullable=False)
+    score = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        return "<SimilarRecipe recipe_id=%s similar_recipe_id=%s rank=%s>" % (
+                                                            self.recipe_id,
+                                                            self.similar_recipe_id,
+                                                            self.rank)
+
+
+class RecipeConversion(db.Model):
+    """Precomputed ingredient conversion of a recipe to a serving size."""
+
+    __tablename__ = "recipesconversions"
+    __table_args__ = (db.UniqueConstraint("recipe_id", "serving_size", "format_version"),)
+
+    recipeconversion_id = db.Column(db.Integer,
+                                    autoincrement=True,
+                                    primary_key=True)
+    recipe_id = db.Column(db.Integer,
+                          db.ForeignKey('recipes.recipe_id'))
+    serving_size = db.Column(db.Integer, nullable=False)
+    # functions.FORMAT_VERSION of the formatter the conversion was made with
+    format_version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    # converted ingredients, serialized as served by /show_conversion.json
+    conversion = db.Column(db.Text, nullable=False)
+    etag = db.Column(db.String(40), nullable=False)
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        return "<RecipeConversion recipe_id=%s serving_size=%s>" % (self.recipe_id,
+                                                                    self.serving_size)
+
+
+class RecipeDocument(db.Model):
+    """Denormalized recipe, everything its page and conversions show."""
+
+    __tablename__ = "recipesdocuments"
+
+    recipe_id = db.Column(db.Integer,
+                          db.ForeignKey('recipes.recipe_id'),
+                          primary_key=True)
+    # serialized by functions.build_recipe_document
+    document = db.Column(db.Text, nullable=False)
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        return "<RecipeDocument recipe_id=%s>" % self.recipe_id
+
+
+class CatalogVersion(db.Model):
+    """Version of the recipe catalog, one row, changed whenever it is seeded."""
+
+    __tablename__ = "catalogversions"
+
+    catalog_id = db.Column(db.Integer, primary_key=True)
+    # random, so a recreated database never repeats an older version
+    version = db.Column(db.String(32), nullable=False)
+    modified = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        return "<CatalogVersion version=%s>" % self.version
+
+
 #####   HELPER FUNCTIONS  ######################################################
 
 def connect_to_db(app, db_uri='postgresql:///recipes'):
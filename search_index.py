@@ -0,0 +1,427 @@
+"""In-memory inverted index for recipe search."""
+
+from bisect import bisect_left, bisect_right
+import heapq
+import math
+from model import db, Recipe, Ingredient, Course, RecipeIngredient, RecipeCourse, IngredientType
+from caches import get_catalog_version
+
+# maximum times, in minutes, that search results are counted under
+TIME_BUCKETS = [15, 30, 60, 120]
+
+# version of an index that has never been built; unlike None, which is
+# the catalog version of a database that has never been seeded, it
+# matches no catalog version
+NOT_BUILT = object()
+
+
+def bitmap_positions(bitmap, limit=None):
+    """Return the positions of the set bits in bitmap, lowest first."""
+
+    positions = []
+    bits = bin(bitmap)[:1:-1]
+
+    position = bits.find('1')
+    while position != -1:
+        positions.append(position)
+        if limit and len(positions) == limit:
+            break
+        position = bits.find('1', position + 1)
+
+    return positions
+
+
+def bitmap_count(bitmap):
+    """Return the number of set bits in bitmap."""
+
+    return bin(bitmap).count('1')
+
+
+def bitmap_from_positions(positions):
+    """Return a bitmap with the given bit positions set."""
+
+    if not positions:
+        return 0
+
+    bits = bytearray('0' * (max(positions) + 1))
+    for position in positions:
+        bits[position] = ord('1')
+
+    return int(str(bits[::-1]), 2)
+
+
+def bitmaps_from_rows(rows, positions):
+    """Return a dictionary of name to bitmap from (name, recipe_id) rows."""
+
+    recipes = {}
+    for name, recipe_id in rows:
+        recipes.setdefault(name, []).append(positions[recipe_id])
+
+    return dict((name, bitmap_from_positions(found)) for name, found in recipes.items())
+
+
+def cumulative_bitmaps(values):
+    """Return sorted distinct values with cumulative bitmaps.
+
+    The bitmap for each value has every position whose value is at most
+    that value set.
+    """
+
+    by_value = {}
+    for position, value in enumerate(values):
+        by_value.setdefault(value, []).append(position)
+
+    keys = sorted(by_value)
+    bitmaps = []
+    running = 0
+    for key in keys:
+        running |= bitmap_from_positions(by_value[key])
+        bitmaps.append(running)
+
+    return keys, bitmaps
+
+
+class CatalogIndex(object):
+    """In-memory index built from the recipe catalog.
+
+    Subclasses define build(), which loads them from the database, and
+    are rebuilt on first use after the catalog version changes.
+    """
+
+    def __init__(self):
+        self.version = NOT_BUILT
+
+    def ensure_built(self):
+        """Build the index if it is missing or older than the catalog."""
+
+        if self.version != get_catalog_version():
+            self.build()
+
+
+class SearchIndex(CatalogIndex):
+    """Inverted index from ingredients, courses and times to recipes.
+
+    Every recipe is given a bit position by its place in recipe_name order,
+    and each ingredient and course maps to a bitmap (a Python long) of the
+    recipes that use it. "any" and "all" searches are then bitwise unions
+    and intersections, and decoding a bitmap gives recipe ids already
+    sorted by name. The index is rebuilt when the catalog version changes.
+    """
+
+    def build(self):
+        """Load the index from the database."""
+
+        version = get_catalog_version()
+        recipe_ids = []
+        positions = {}
+        recipe_times = []
+
+        recipes = db.session.query(Recipe.recipe_id,
+                                   Recipe.time_in_min).order_by(Recipe.recipe_name,
+                                                                Recipe.recipe_id).all()
+
+        for recipe_id, time_in_min in recipes:
+            positions[recipe_id] = len(recipe_ids)
+            recipe_ids.append(recipe_id)
+            recipe_times.append(time_in_min)
+
+        rows = db.session.query(Ingredient.ingredient_name,
+                                RecipeIngredient.recipe_id).join(RecipeIngredient,
+                                    RecipeIngredient.ingredient_id == Ingredient.ingredient_id).all()
+
+        ingredients = bitmaps_from_rows(rows, positions)
+
+        # each recipe's distinct ingredients, and its ingredient rows
+        recipe_ingredients = [set() for recipe_id in recipe_ids]
+        recipe_sizes = [0] * len(recipe_ids)
+        for ingredient_name, recipe_id in rows:
+            recipe_ingredients[positions[recipe_id]].add(ingredient_name)
+            recipe_sizes[positions[recipe_id]] += 1
+
+        types = {}
+        rows = db.session.query(IngredientType.type_name,
+                                Ingredient.ingredient_name).join(Ingredient,
+                                    Ingredient.type_id == IngredientType.type_id).all()
+
+        for type_name, ingredient_name in rows:
+            types[type_name] = types.get(type_name, 0) | ingredients.get(ingredient_name, 0)
+
+        rows = db.session.query(Course.course_name,
+                                RecipeCourse.recipe_id).join(RecipeCourse,
+                                    RecipeCourse.course_id == Course.course_id).all()
+
+        courses = bitmaps_from_rows(rows, positions)
+
+        # time_bitmaps[i] holds every recipe taking times[i] minutes or less,
+        # and size_bitmaps[i] every recipe with sizes[i] ingredients or fewer
+        times, time_bitmaps = cumulative_bitmaps(recipe_times)
+        sizes, size_bitmaps = cumulative_bitmaps([len(found) for found in recipe_ingredients])
+
+        self.recipe_ids = recipe_ids
+        self.positions = positions
+        self.recipe_times = recipe_times
+        self.recipe_sizes = recipe_sizes
+        self.average_size = float(sum(recipe_sizes)) / len(recipe_sizes) if recipe_sizes else 1.0
+        self.ingredients = ingredients
+        self.types = types
+        self.courses = courses
+        self.times = times
+        self.time_bitmaps = time_bitmaps
+        self.sizes = sizes
+        self.size_bitmaps = size_bitmaps
+        self.all_recipes = (1 << len(recipe_ids)) - 1
+        self.with_ingredients = self.all_recipes
+        if sizes and sizes[0] == 0:
+            self.with_ingredients &= ~size_bitmaps[0]
+        self.version = version
+
+    def match_terms(self, terms, lookup, search_term):
+        """Return bitmap of recipes matching any/all of the terms."""
+
+        bitmaps = [lookup.get(term, 0) for term in terms]
+
+        if search_term == "all":
+            return reduce(lambda a, b: a & b, bitmaps)
+
+        return reduce(lambda a, b: a | b, bitmaps)
+
+    def match_time(self, time):
+        """Return bitmap of recipes that are under the maximum time given."""
+
+        i = bisect_left(self.times, int(time))
+
+        if i == 0:
+            return 0
+
+        return self.time_bitmaps[i - 1]
+
+    def match_size(self, size):
+        """Return bitmap of recipes with at most size ingredients."""
+
+        i = bisect_right(self.sizes, size)
+
+        if i == 0:
+            return 0
+
+        return self.size_bitmaps[i - 1]
+
+    def match_pantry(self, ingredients, missing=0):
+        """Return bitmap of recipes that can be made from the ingredients.
+
+        A recipe is kept if at most missing of its ingredients are not in
+        the pantry, that is, if it has at least its size less missing
+        pantry ingredients. How many pantry ingredients each recipe has is
+        counted bit-sliced: at_least[c] is the bitmap of recipes with c or
+        more of them, so the whole search is a few bitmap operations per
+        pantry ingredient, whatever the size of the catalog. Recipes
+        without ingredients are never kept, as in the SQL search.
+        """
+
+        pantry = [self.ingredients[ingredient_name] for ingredient_name in set(ingredients)
+                  if ingredient_name in self.ingredients]
+
+        at_least = [self.all_recipes]
+        for bitmap in pantry:
+            at_least.append(at_least[-1] & bitmap)
+            for c in xrange(len(at_least) - 2, 0, -1):
+                at_least[c] |= at_least[c - 1] & bitmap
+
+        found = 0
+        for c, bitmap in enumerate(at_least):
+            found |= bitmap & self.match_size(c + missing)
+
+        return found & self.with_ingredients
+
+    def match(self, search_term, ingredients, courses, time, missing=0):
+        """Return bitmap of recipes that match the search parameters.
+
+        search_term is "any", "all" or "pantry". A pantry search keeps
+        recipes whose ingredients are (all but missing of them) among the
+        ingredients given, further narrowed by any courses and time.
+        """
+
+        self.ensure_built()
+
+        found = []
+
+        if search_term == "pantry":
+            found.append(self.match_pantry(ingredients, missing))
+        elif ingredients:
+            found.append(self.match_terms(ingredients, self.ingredients, search_term))
+
+        if courses:
+            found.append(self.match_terms(courses, self.courses, search_term))
+
+        if time:
+            found.append(self.match_time(time))
+
+        if not found:
+            return self.all_recipes
+
+        if search_term == "any":
+            return reduce(lambda a, b: a | b, found)
+
+        return reduce(lambda a, b: a & b, found)
+
+    def recipe_ids_for(self, bitmap, after=None, limit=None):
+        """Return recipe ids in bitmap, ordered by recipe name.
+
+        after is the recipe id of the last recipe already shown; only the
+        recipes that sort after it are returned. An after that is not in
+        the catalog, like a cursor from before a reseed, returns nothing,
+        as the SQL search does.
+        """
+
+        start = 0
+        if after:
+            if after not in self.positions:
+                return []
+            start = self.positions[after] + 1
+
+        return [self.recipe_ids[start + position] for position in bitmap_positions(bitmap >> start, limit)]
+
+    def facets(self, bitmap):
+        """Return recipe counts per course, ingredient type and time bucket.
+
+        Counts are of the recipes in bitmap, so they show what each filter
+        would return alongside the current ones.
+        """
+
+        self.ensure_built()
+
+        facets = {"total": bitmap_count(bitmap)}
+
+        for facet, lookup in [("courses", self.courses), ("types", self.types)]:
+            counts = []
+            for name in sorted(lookup):
+                count = bitmap_count(bitmap & lookup[name])
+                if count:
+                    counts.append((name, count))
+            facets[facet] = counts
+
+        facets["times"] = [(minutes, bitmap_count(bitmap & self.match_time(minutes))) for minutes in TIME_BUCKETS]
+
+        return facets
+
+    def rank(self, ingredients, courses, time=None, k=24, k1=1.2, b=0.75):
+        """Return the ids of the k recipes that best match, best first.
+
+        Each matched ingredient or course adds its inverse document
+        frequency, so common ingredients like salt count for little, and
+        the total is BM25 length-normalized by the recipe's ingredient
+        count. If time is given, recipes that take longer are penalized in
+        proportion instead of being dropped. Without ingredients or
+        courses, nothing is weighted, so the recipes within the time are
+        ranked by the time penalty alone: they tie, and go by name.
+        """
+
+        self.ensure_built()
+
+        total = len(self.recipe_ids)
+        if not total:
+            return []
+
+        if not ingredients and not courses:
+            return self.recipe_ids_for(self.match("any", [], [], time), limit=k)
+
+        average_size = self.average_size or 1.0
+        weights = {}
+
+        for terms, lookup in [(ingredients, self.ingredients), (courses, self.courses)]:
+            for term in set(terms):
+                positions = bitmap_positions(lookup.get(term, 0))
+                found = len(positions)
+                idf = math.log(1.0 + (total - found + 0.5) / (found + 0.5))
+
+                for position in positions:
+                    weights[position] = weights.get(position, 0.0) + idf
+
+        scores = []
+        for position, weight in weights.items():
+            size = self.recipe_sizes[position]
+            score = weight * (k1 + 1) / (1 + k1 * (1 - b + b * size / average_size))
+
+            recipe_time = self.recipe_times[position]
+            if time and recipe_time > int(time):
+                score *= float(time) / recipe_time
+
+            # ties go to the recipe that comes first by name
+            scores.append((score, -position))
+
+        return [self.recipe_ids[-order] for score, order in heapq.nlargest(k, scores)]
+
+
+class IngredientVocabulary(CatalogIndex):
+    """Sorted arrays of ingredient names for typeahead lookups.
+
+    Prefix queries binary-search the sorted names; infix queries
+    binary-search a sorted array of the later words of each name, so
+    "oni" finds "red onion" as well as "onion powder".
+    """
+
+    def build(self):
+        """Load the ingredient names from the database."""
+
+        version = get_catalog_version()
+
+        names = []
+        words = []
+        by_type = {}
+
+        rows = db.session.query(Ingredient.ingredient_name,
+                                Ingredient.type_id).order_by(Ingredient.ingredient_name).all()
+
+        for ingredient_name, type_id in rows:
+            key = ingredient_name.lower()
+            names.append((key, ingredient_name))
+            for word in key.split()[1:]:
+                words.append((word, ingredient_name))
+            by_type.setdefault(type_id, []).append(ingredient_name)
+
+        names.sort()
+        words.sort()
+
+        self.names = names
+        self.words = words
+        self.by_type = by_type
+        self.version = version
+
+    def starting_with(self, entries, prefix):
+        """Yield the names whose key in sorted entries starts with prefix."""
+
+        for i in xrange(bisect_left(entries, (prefix,)), len(entries)):
+            key, ingredient_name = entries[i]
+            if not key.startswith(prefix):
+                break
+            yield ingredient_name
+
+    def complete(self, query, limit=10):
+        """Return up to limit ingredient names matching query, prefix matches first."""
+
+        self.ensure_built()
+
+        query = query.strip().lower()
+        if not query:
+            return []
+
+        found = []
+
+        for entries in [self.names, self.words]:
+            for ingredient_name in self.starting_with(entries, query):
+                if ingredient_name not in found:
+                    found.append(ingredient_name)
+                if len(found) == limit:
+                    return found
+
+        return found
+
+    def names_for_type(self, type_id):
+        """Return the sorted ingredient names of an ingredient type."""
+
+        self.ensure_built()
+
+        return self.by_type.get(type_id, [])
+
+
+search_index = SearchIndex()
+ingredient_vocabulary = IngredientVocabulary()
@@ -1,15 +1,19 @@
 """Utility file to seed database with data from api and through webscraping"""
 
-from model import User, Box, RecipeBox, Recipe, Website, Serving, Ingredient, USUnit, MetricUnit, USAmount, MetricAmount, Instruction, Course, RecipeIngredient, IngredientType, RecipeServing, USIngredientMeasure, MetricIngredientMeasure, RecipeCourse
+from model import User, Box, RecipeBox, Recipe, Website, Serving, Ingredient, USUnit, MetricUnit, USAmount, MetricAmount, Instruction, Course, RecipeIngredient, IngredientType, RecipeServing, USIngredientMeasure, MetricIngredientMeasure, RecipeCourse, SimilarRecipe, RecipeConversion, RecipeDocument
 
 from model import connect_to_db, db
 from server import app
 from webscrape_details import get_all_recipe_info
+from caches import bump_catalog_version
+from similarity import similar_recipes
+from functions import build_recipe_conversions, build_recipe_document, load_document_recipe, get_recipe_document
 import unirest
 import os
 import re
 import bcrypt
 import ast
+import json
 
 
 def load_users(username, password):
@@ -64,6 +68,8 @@ def load_website(site_name):
 
     db.session.commit()
 
+    bump_catalog_version()
+
 
 def load_courses(courses):
     """Load course(s) for the recipe."""
@@ -79,6 +85,8 @@ def load_courses(courses):
 
     db.session.commit()
 
+    bump_catalog_version()
+
 
 def load_servings(servings):
     """Load serving size(s) for the recipe."""
@@ -92,6 +100,8 @@ def load_servings(servings):
 
     db.session.commit()
 
+    bump_catalog_version()
+
 
 def load_ingredienttypes(all_ingredients):
     """Load ingredient types for the recipe."""
@@ -108,6 +118,8 @@ def load_ingredienttypes(all_ingredients):
 
     db.session.commit()
 
+    bump_catalog_version()
+
 
 def load_ingredients(all_ingredients):
     """Load ingredients for the recipe."""
@@ -126,6 +138,8 @@ def load_ingredients(all_ingredients):
 
     db.session.commit()
 
+    bump_catalog_version()
+
 
 def load_measurements(scrape_ingredients):
     """Load measurement units and amounts for the recipe."""
@@ -177,6 +191,8 @@ def load_measurements(scrape_ingredients):
 
     db.session.commit()
 
+    bump_catalog_version()
+
 
 def load_recipes(recipe_name, recipe_api_id, time_in_min, site_name, src_url, img_url):
     """Load recipes into database."""
@@ -197,6 +213,8 @@ def load_recipes(recipe_name, recipe_api_id, time_in_min, site_name, src_url, im
 
     db.session.commit()
 
+    bump_catalog_version()
+
 
 def load_recipe_ingredients(recipe_name, all_ingredients, scrape_ingredients):
     """Load recipeingredients into database."""
@@ -258,6 +276,8 @@ def load_recipe_ingredients(recipe_name, all_ingredients, scrape_ingredients):
 
     db.session.commit()
 
+    bump_catalog_version()
+
 
 def load_instructions(recipe_name, instruction_info):
     """Load instructions for the recipe."""
@@ -277,6 +297,8 @@ def load_instructions(recipe_name, instruction_info):
 
     db.session.commit()
 
+    bump_catalog_version()
+
 
 def load_ingredient_measures(scrape_ingredients, all_ingredients, recipe_name):
     """Load ingredientmeasures for recipe."""
@@ -362,6 +384,8 @@ def load_ingredient_measures(scrape_ingredients, all_ingredients, recipe_name):
 
     db.session.commit()
 
+    bump_catalog_version()
+
 
 def load_recipe_servings(servings, recipe_name):
     """Load recipeservings for recipe."""
@@ -378,6 +402,8 @@ def load_recipe_servings(servings, recipe_name):
 
     db.session.commit()
 
+    bump_catalog_version()
+
 
 def load_recipe_courses(recipe_name, courses):
     """Load recipecourses for recipe."""
@@ -394,6 +420,78 @@ def load_recipe_courses(recipe_name, courses):
 
     db.session.commit()
 
+    bump_catalog_version()
+
+
+def load_similar_recipes(k=6):
+    """Load the k most similar recipes for every recipe.
+
+    Run once after all recipes are loaded; any earlier neighbor lists are
+    replaced.
+    """
+
+    print "Similar Recipes"
+
+    pairs = db.session.query(RecipeIngredient.recipe_id,
+                             RecipeIngredient.ingredient_id).filter(
+                                RecipeIngredient.ingredient_id.isnot(None)).all()
+
+    rows = [{"recipe_id": recipe_id,
+             "similar_recipe_id": similar_recipe_id,
+             "rank": rank,
+             "score": score}
+            for recipe_id, similar_recipe_id, rank, score in similar_recipes(pairs, k)]
+
+    SimilarRecipe.query.delete()
+    if rows:
+        db.session.execute(SimilarRecipe.__table__.insert(), rows)
+
+    db.session.commit()
+
+    bump_catalog_version()
+
+
+def load_recipe_documents():
+    """Load the denormalized document of every recipe.
+
+    Run once after all recipes and similar recipes are loaded; any earlier
+    documents are replaced, in the same transaction, so a reseed never
+    leaves documents of the old recipes behind.
+    """
+
+    print "Recipe Documents"
+
+    RecipeDocument.query.delete()
+
+    for recipe_id, in db.session.query(Recipe.recipe_id).all():
+        document = build_recipe_document(load_document_recipe(recipe_id))
+        db.session.execute(RecipeDocument.__table__.insert(),
+                           {"recipe_id": recipe_id,
+                            "document": json.dumps(document, separators=(',', ':'))})
+
+    db.session.commit()
+
+    bump_catalog_version()
+
+
+def load_recipe_conversions():
+    """Load the serving-size conversions of every recipe.
+
+    Run once after the recipe documents are loaded, which they are made
+    from; any earlier conversions, whatever their format version, are
+    replaced.
+    """
+
+    print "Recipe Conversions"
+
+    RecipeConversion.query.delete()
+
+    for recipe_id, in db.session.query(Recipe.recipe_id).all():
+        db.session.execute(RecipeConversion.__table__.insert(),
+                           build_recipe_conversions(get_recipe_document(recipe_id)))
+
+    db.session.commit()
+
 
 ###############################################################################
 
@@ -516,6 +614,10 @@ def example_recipes():
         all_info = rows[i * 3:(i * 3) + 3]
         add_recipe_data(all_info)
 
+    load_similar_recipes()
+    load_recipe_documents()
+    load_recipe_conversions()
+
 
 def example_user_boxes():
     """Create sample user and user boxes for testing purposes."""
@@ -563,6 +665,8 @@ def update_database():
 
     db.session.commit()
 
+    bump_catalog_version()
+
 
 if __name__ == "__main__":
     connect_to_db(app)
@@ -589,4 +693,7 @@ if __name__ == "__main__":
         add_recipe_data(all_info)
 
     update_database()
+    load_similar_recipes()
+    load_recipe_documents()
+    load_recipe_conversions()
     add_users_boxes()
@@ -2,14 +2,20 @@
 
 import os
 from jinja2 import StrictUndefined
-from flask import Flask, render_template, redirect, flash, session, request
+from flask import Flask, render_template, redirect, flash, session, request, Response, stream_with_context, abort
 from flask_debugtoolbar import DebugToolbarExtension
 from model import connect_to_db, db
-from model import User, Recipe, Course, IngredientType, Box, RecipeBox
-from functions import get_my_recipes_data, convert_ingredients, find_matching_recipes
+from model import User, Course, IngredientType, Box, RecipeBox
+from functions import get_my_recipes_data, find_matching_recipes, rank_matching_recipes, count_matching_recipes, get_recipe_conversion, scale_recipes, SERVING_SIZES
+from functions import shopping_list_query, reduce_shopping_list, amount_payload, load_recipe_document, get_recipe_document, get_user_boxes
+from functions import check_box_operations, apply_box_operations, get_my_recipes_boxes, get_box_counts, get_box_page
+from caches import get_cache_stats, get_catalog_version, get_catalog_modified, page_cache, bump_box_version, get_box_version
+from search_index import ingredient_vocabulary
 import json
+import hashlib
 import bcrypt
 from werkzeug import secure_filename
+from werkzeug.urls import url_encode
 
 app = Flask(__name__)
 app.secret_key = "ABC"
@@ -18,6 +24,16 @@ app.config['UPLOAD_FOLDER'] = 'static/uploads/'
 app.config['ALLOWED_EXTENSIONS'] = set(['png', 'jpg', 'jpeg'])
 app.config['MAX_CONTENT_LENGTH'] = 1 * 1024 * 1024
 
+# match searches with the in-memory index instead of a single SQL query
+app.config['SEARCH_INDEX'] = True
+
+# page size for search results, and whether to stream the rendered page
+app.config['RESULTS_PER_PAGE'] = 24
+app.config['STREAM_RESULTS'] = True
+
+# saved recipes fetched at a time when a label is opened in my_recipes
+app.config['BOX_PAGE_SIZE'] = 24
+
 app.jinja_env.undefined = StrictUndefined
 
 
@@ -109,12 +125,12 @@ def show_profile():
     """Show user profile."""
 
     if session.get("user_id"):
-        user = User.query.filter_by(user_id=session["user_id"]).first()
-        boxes = user.boxes
+        user_boxes = get_user_boxes(session["user_id"])
 
         return render_template("profile.html",
-                               user=user,
-                               boxes=boxes)
+                               user=user_boxes["user"],
+                               boxes=user_boxes["boxes"],
+                               version=get_box_version(session["user_id"]))
 
 
 @app.route('/upload', methods=['POST'])
@@ -134,6 +150,7 @@ def upload_img():
 
         user.profile_img = filename
 
+        bump_box_version(user.user_id)
         db.session.commit()
 
         flash("Upload successful.")
@@ -155,40 +172,126 @@ def show_search_form():
                            all_courses=all_courses)
 
 
+@app.route('/ingredients.json')
+def show_ingredient_names():
+    """Return ingredient names for the search form typeahead.
+
+    With q, returns names starting with (or containing a word starting
+    with) q. With type_id, returns every ingredient of that type.
+    """
+
+    query = request.args.get("q")
+    type_id = request.args.get("type_id", type=int)
+    limit = max(1, min(request.args.get("limit", 10, type=int), 50))
+
+    if query:
+        names = ingredient_vocabulary.complete(query, limit=limit)
+    else:
+        names = ingredient_vocabulary.names_for_type(type_id)
+
+    return json.dumps(names)
+
+
 @app.route('/results')
 def show_search_results():
-    """Display the search results."""
+    """Display the search results, one page at a time."""
 
     all_ingredients = request.args.getlist("ingredient")
     all_courses = request.args.getlist("course")
     max_time = request.args.get("time")
     search_term = request.args.get("search-term")
+    missing = request.args.get("missing", 0, type=int)
+    after = request.args.get("after", type=int)
+    per_page = app.config['RESULTS_PER_PAGE']
 
-    matching_recipes = find_matching_recipes(search_term=search_term, ingredients=all_ingredients, courses=all_courses, time=max_time)
+    ranked = search_term == "any" and request.args.get("order") == "rank"
+
+    if ranked:
+        # best matches first, top page only
+        matching_recipes = rank_matching_recipes(ingredients=all_ingredients, courses=all_courses, time=max_time, k=per_page)
+    else:
+        # ask for one extra recipe to know if there is another page
+        matching_recipes = find_matching_recipes(search_term=search_term, ingredients=all_ingredients, courses=all_courses, time=max_time, missing=missing, after=after, limit=per_page + 1)
+
+    facets = count_matching_recipes(search_term=search_term, ingredients=all_ingredients, courses=all_courses, time=max_time, missing=missing)
+
+    next_url = None
+    if len(matching_recipes) > per_page:
+        matching_recipes = matching_recipes[:per_page]
+        next_args = request.args.copy()
+        next_args["after"] = matching_recipes[-1].recipe_id
+        next_url = "/results?" + url_encode(next_args)
 
     if max_time:
         max_time = "under " + max_time + " min"
     else:
         max_time = " "
 
-    return render_template("results.html",
-                           matching_recipes=matching_recipes,
-                           ingredients=all_ingredients,
-                           courses=all_courses,
-                           time=max_time,
-                           search=search_term)
+    context = dict(matching_recipes=matching_recipes,
+                   ingredients=all_ingredients,
+                   courses=all_courses,
+                   time=max_time,
+                   search=search_term,
+                   facets=facets,
+                   next_url=next_url)
+
+    # flashes are removed from the session as the page renders, which a
+    # streamed page does after the session cookie is sent
+    if app.config['STREAM_RESULTS'] and not session.get("_flashes"):
+        return Response(stream_with_context(stream_template("results.html", **context)))
+
+    return render_template("results.html", **context)
 
 
 @app.route('/recipe/<int:recipe_id>')
 def show_recipe(recipe_id):
-    """Show detailed recipe page."""
+    """Show detailed recipe page.
 
-    recipe = Recipe.query.get(recipe_id)
-    serving_range = range(1, 13)
+    Rendered pages only change with the catalog, so they are cached by
+    recipe, catalog version and logged-in user, whose name and Save
+    Recipe button are on the page. Pages showing flashed messages are
+    rendered fresh.
+    """
 
-    return render_template("recipe.html",
-                           recipe=recipe,
-                           serving_range=serving_range)
+    user = (session["user_id"], session.get("username")) if session.get("user_id") else None
+    key = (recipe_id, get_catalog_version(), user)
+    cacheable = not session.get("_flashes")
+
+    page = page_cache.get(key) if cacheable else None
+
+    if page is None:
+        html = render_recipe(recipe_id)
+        page = (html, hashlib.sha1(html.encode("utf-8")).hexdigest())
+
+        if cacheable:
+            page_cache.set(key, page)
+
+    response = Response(page[0])
+    response.set_etag(page[1])
+    # the catalog's modified time is shared by every user's variant, so
+    # only the anonymous page can be revalidated by date
+    if user is None:
+        response.last_modified = get_catalog_modified()
+    # the page differs by login, so it is revalidated rather than reused
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+
+    return response.make_conditional(request)
+
+
+@app.route('/recipe/<int:recipe_id>.json')
+def show_recipe_document(recipe_id):
+    """Returns the stored document of a recipe."""
+
+    document = load_recipe_document(recipe_id)
+    if not document:
+        abort(404)
+
+    response = Response(document, mimetype="application/json")
+    response.set_etag(hashlib.sha1(document.encode("utf-8")).hexdigest())
+    response.last_modified = get_catalog_modified()
+
+    return response.make_conditional(request)
 
 
 @app.route('/save_recipe/<int:recipe_id>')
@@ -196,9 +299,8 @@ def show_add_recipe(recipe_id):
     """Show form for user to save recipe to recipe box."""
 
     if session.get("user_id"):
-        recipe = Recipe.query.filter_by(recipe_id=recipe_id).first()
-        user_id = session['user_id']
-        boxes = Box.query.filter_by(user_id=user_id).all()
+        recipe = get_recipe_document(recipe_id)
+        boxes = get_user_boxes(session['user_id'])["boxes"]
 
         return render_template("save_recipe.html",
                                recipe=recipe,
@@ -225,6 +327,7 @@ def save_recipe_to_box():
             box = Box(user_id=user_id,
                       label_name=new_label_name)
             db.session.add(box)
+            bump_box_version(user_id)
             db.session.commit()
 
             box_id = Box.query.filter_by(user_id=user_id, label_name=new_label_name).first().box_id
@@ -240,6 +343,7 @@ def save_recipe_to_box():
                                   box_id=box_id,
                                   recipe_notes=notes)
             db.session.add(recipebox)
+            bump_box_version(user_id)
             db.session.commit()
 
             return redirect("/my_recipes")
@@ -271,6 +375,7 @@ def update_settings():
             if password:
                 user.password = bcrypt.hashpw(password, bcrypt.gensalt())
 
+            bump_box_version(user_id)
             db.session.commit()
 
             flash("Your information has been updated.")
@@ -284,39 +389,110 @@ def update_settings():
 
 @app.route('/update_my_recipes', methods=["POST"])
 def update_recipe_box():
-    """Update database with new info for user's recipe boxes."""
+    """Update database with new info for user's recipe boxes.
+
+    Returns the change as JSON, with the version of the boxes after it,
+    for profile.js to apply to the page it shows.
+    """
 
+    user_id = session.get("user_id")
     box_id = int(request.form.get("box_id"))
     recipe_id = int(request.form.get("recipe_id"))
     delete = request.form.get("delete")
 
-    if delete == "Y":
+    # only the logged-in user's own boxes, as in update_recipe_boxes
+    box = Box.query.filter_by(box_id=box_id, user_id=user_id).first() if user_id else None
+    if not box:
+        abort(404)
+
+    delta = {"message": "Update successful",
+             "box_id": box_id,
+             "recipe_id": recipe_id}
+
+    if delete == "Y" or recipe_id != (-1):
         recipebox = RecipeBox.query.filter_by(box_id=box_id, recipe_id=recipe_id).first()
+        if not recipebox:
+            abort(404)
+
+    if delete == "Y":
         db.session.delete(recipebox)
-        db.session.commit()
+        delta["deleted"] = True
     elif recipe_id != (-1):
         notes = request.form.get("notes")
-        recipebox = RecipeBox.query.filter_by(box_id=box_id, recipe_id=recipe_id).first()
         recipebox.recipe_notes = notes
-        db.session.commit()
+        delta["notes"] = notes
     else:
         label_name = request.form.get("label_name")
-        box = Box.query.filter_by(box_id=box_id).first()
         box.label_name = label_name
-        db.session.commit()
+        delta["label_name"] = label_name
+
+    delta["version"] = bump_box_version(user_id)
+    db.session.commit()
+
+    return Response(json.dumps(delta), mimetype="application/json")
+
+
+@app.route('/update_my_recipes.json', methods=["POST"])
+def update_recipe_boxes():
+    """Apply a batch of edits to the user's recipe boxes in one transaction.
 
-    return "Update successful"
+    Takes JSON like {"operations": [{"op": "create", "ref": "new",
+    "label_name": "Brunch"}, {"op": "move", "box_id": 1, "recipe_id": 2,
+    "to_box_id": "new"}]}; see functions.BOX_OPERATIONS for every kind.
+    Returns the ids of created boxes by ref and the new box version.
+    """
+
+    user_id = session.get("user_id")
+    operations = (request.get_json(silent=True) or {}).get("operations")
+
+    if not user_id:
+        abort(404)
+    if not isinstance(operations, list):
+        abort(400)
+
+    box_ids = check_box_operations(operations)
+    if box_ids is None:
+        abort(400)
+
+    if box_ids and Box.query.filter(Box.box_id.in_(box_ids), Box.user_id == user_id).count() != len(box_ids):
+        abort(404)
+
+    try:
+        created = apply_box_operations(user_id, operations)
+    except ValueError:
+        abort(400)
+
+    return Response(json.dumps({"message": "Update successful",
+                                "created": created,
+                                "version": get_box_version(user_id)}),
+                    mimetype="application/json")
 
 
 @app.route('/preview.html')
 def update_preview():
-    """Send updated preview of users recipe boxes to front-end."""
+    """Send updated preview of users recipe boxes to front-end.
+
+    The preview only changes with the user's boxes and the catalog, so
+    a browser holding the current one gets a 304 without it being
+    rendered. Both versions are read from the database, so the ETag
+    means the same boxes on every worker and across restarts.
+    """
 
     user_id = session["user_id"]
-    boxes = User.query.filter_by(user_id=user_id).first().boxes
+    version = get_box_version(user_id)
+    etag = "%s-%s-%s" % (user_id, version, get_catalog_version())
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(render_template("preview.html",
+                                            boxes=get_user_boxes(user_id)["boxes"],
+                                            version=version))
 
-    return render_template("preview.html",
-                           boxes=boxes)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+
+    return response
 
 
 @app.route('/show_conversion.json')
@@ -326,25 +502,111 @@ def show_conversion():
     new_serving = int(request.args.get("serving"))
     recipe_id = int(request.args.get("recipe_id"))
 
-    recipe = Recipe.query.filter_by(recipe_id=recipe_id).first()
-    orig_serving = recipe.servings[0].serving_size
-    conversion_amount = float(new_serving) / orig_serving
+    found = get_recipe_conversion(recipe_id, new_serving)
+    if not found:
+        abort(404)
+
+    conversion, etag = found
+
+    response = Response(conversion, mimetype="application/json")
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 3600
+
+    return response.make_conditional(request)
+
+
+@app.route('/scale_recipes.json')
+def show_scaled_recipes():
+    """Returns converted measurements of many recipes in one response.
+
+    Takes paired recipe_id and serving values, e.g.
+    ?recipe_id=1&serving=4&recipe_id=5&serving=12, or the box_id of one of
+    the user's boxes with a single serving for all of its recipes.
+    """
+
+    recipe_ids = request.args.getlist("recipe_id", type=int)
+    new_servings = request.args.getlist("serving", type=int)
+    box_id = request.args.get("box_id", type=int)
+
+    if box_id is not None:
+        box = Box.query.filter_by(box_id=box_id).first()
+        if not box or box.user_id != session.get("user_id") or len(new_servings) != 1:
+            abort(404)
+
+        recipe_ids = [recipebox.recipe_id for recipebox in box.recipesboxes]
+        new_servings = new_servings * len(recipe_ids)
+
+    if len(recipe_ids) != len(new_servings):
+        abort(400)
+
+    return Response(json.dumps(scale_recipes(zip(recipe_ids, new_servings))),
+                    mimetype="application/json")
+
 
-    new_ingredients = convert_ingredients(recipe, conversion_amount)
+@app.route('/shopping_list.json')
+def show_shopping_list():
+    """Returns the combined ingredients of the recipes in the user's boxes.
 
-    return json.dumps(new_ingredients)
+    Takes one or more box_id values and an optional serving to scale every
+    recipe to. The list is streamed as it is reduced from the query rows.
+    """
+
+    box_ids = request.args.getlist("box_id", type=int)
+    serving_size = request.args.get("serving", type=int)
+
+    user_boxes = Box.query.filter(Box.box_id.in_(box_ids), Box.user_id == session.get("user_id")).count() if box_ids else 0
+    if not box_ids or user_boxes != len(set(box_ids)):
+        abort(404)
+
+    rows = shopping_list_query(box_ids).yield_per(500)
+
+    def generate():
+        yield "["
+        for i, item in enumerate(reduce_shopping_list(rows, serving_size)):
+            yield ("," if i else "") + json.dumps(item, separators=(',', ':'))
+        yield "]"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
 
 
 @app.route('/my_recipes.json')
 def get_my_recipes():
-    """Returns json data for my_recipes"""
+    """Returns json data for my_recipes
+
+    With lazy set, only the root and labels, each with its count of
+    recipes; with a box_id, the page of that box's recipes after the
+    recipebox_id in after.
+    """
 
     user_id = session["user_id"]
-    boxes = Box.query.filter_by(user_id=user_id).all()
+    box_id = request.args.get("box_id", type=int)
+
+    if box_id is not None:
+        if box_id not in [box["box_id"] for box in get_box_counts(user_id)]:
+            abort(404)
+        data = get_box_page(box_id,
+                            after=request.args.get("after", type=int),
+                            limit=app.config['BOX_PAGE_SIZE'])
+    elif request.args.get("lazy"):
+        data = get_my_recipes_boxes(user_id)
+    else:
+        data = get_my_recipes_data(user_id)
+
+    return Response(json.dumps(data, separators=(',', ':')), mimetype="application/json")
+
 
-    data = get_my_recipes_data(boxes)
+@app.route('/cache_stats.json')
+def show_cache_stats():
+    """Returns size and hit/miss counters of the in-process caches.
 
-    return json.dumps(data)
+    Only served when debugging or testing.
+    """
+
+    if not (app.debug or app.config.get("TESTING")):
+        abort(404)
+
+    return json.dumps(get_cache_stats())
 
 
 ######### HELPER FUNCTIONS ####################################################
@@ -352,6 +614,36 @@ def get_my_recipes():
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1] in app.config['ALLOWED_EXTENSIONS']
 
+
+def render_recipe(recipe_id):
+    """Render the recipe page of recipe_id from its document."""
+
+    recipe = get_recipe_document(recipe_id)
+    if not recipe:
+        abort(404)
+
+    serving_range = SERVING_SIZES
+
+    # serving changes are scaled in the browser from this, see recipe.js
+    payload = amount_payload(recipe)
+
+    return render_template("recipe.html",
+                           recipe=recipe,
+                           serving_range=serving_range,
+                           similar=recipe["similar"],
+                           payload=payload)
+
+
+def stream_template(template_name, **context):
+    """Render a template as a stream of chunks instead of one string."""
+
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(5)
+
+    return stream
+
 ###############################################################################
 if __name__ == "__main__":
     # We have to set debug=True here, since it has to be True at the
@@ -0,0 +1,98 @@
+"""Batch computation of similar recipes from shared ingredients."""
+
+import numpy as np
+from scipy import sparse
+
+
+def ingredient_matrix(pairs):
+    """Return a binary sparse recipe x ingredient matrix and its recipe ids.
+
+    pairs are (recipe_id, ingredient_id) tuples.
+    """
+
+    pairs = set(pairs)
+
+    recipe_ids = sorted(set(recipe_id for recipe_id, ingredient_id in pairs))
+    ingredient_ids = sorted(set(ingredient_id for recipe_id, ingredient_id in pairs))
+
+    rows = dict((recipe_id, i) for i, recipe_id in enumerate(recipe_ids))
+    cols = dict((ingredient_id, i) for i, ingredient_id in enumerate(ingredient_ids))
+
+    row_index = np.fromiter((rows[recipe_id] for recipe_id, ingredient_id in pairs), dtype=np.int32, count=len(pairs))
+    col_index = np.fromiter((cols[ingredient_id] for recipe_id, ingredient_id in pairs), dtype=np.int32, count=len(pairs))
+    data = np.ones(len(pairs), dtype=np.float32)
+
+    matrix = sparse.csr_matrix((data, (row_index, col_index)),
+                               shape=(len(recipe_ids), len(ingredient_ids)))
+
+    return matrix, recipe_ids
+
+
+def similar_recipes(pairs, k=6, metric="cosine", block_size=1024, stop_share=0.05, stop_min=100):
+    """Return (recipe_id, similar_recipe_id, rank, score) for every recipe.
+
+    Similarity is cosine or Jaccard over the recipes' ingredient sets.
+    Shared-ingredient counts are computed as a sparse matrix product one
+    block of recipes at a time, so memory stays bounded and no pair of
+    recipes without a shared ingredient is ever scored.
+
+    Staples in more than stop_share of the recipes (and at least stop_min)
+    would pair almost every recipe with every other, so they are left out
+    of the product: only recipes sharing a rarer ingredient are paired.
+    Their staples are then added back in, so the scores are exact.
+    """
+
+    if not pairs:
+        return []
+
+    matrix, recipe_ids = ingredient_matrix(pairs)
+    sizes = np.asarray(matrix.sum(axis=1), dtype=np.float32).ravel()
+
+    counts = np.asarray(matrix.sum(axis=0)).ravel()
+    is_staple = counts > max(stop_share * matrix.shape[0], stop_min)
+    staples = matrix[:, np.flatnonzero(is_staple)].tocsr()
+    rare = matrix[:, np.flatnonzero(~is_staple)].tocsr()
+    transposed = rare.T.tocsr()
+
+    found = []
+
+    for start in xrange(0, matrix.shape[0], block_size):
+        # shared rare ingredient counts between this block and every recipe
+        shared = rare[start:start + block_size].dot(transposed).tocoo()
+        rows = shared.row + start
+        cols = shared.col
+
+        if staples.shape[1]:
+            shared.data += np.asarray(staples[rows].multiply(staples[cols]).sum(axis=1),
+                                      dtype=np.float32).ravel()
+
+        if metric == "jaccard":
+            scores = shared.data / (sizes[rows] + sizes[cols] - shared.data)
+        else:
+            scores = shared.data / np.sqrt(sizes[rows] * sizes[cols])
+
+        # a recipe is not similar to itself
+        scores[rows == cols] = 0
+
+        block = sparse.csr_matrix((scores, (shared.row, cols)), shape=shared.shape)
+        block.eliminate_zeros()
+
+        for i in xrange(block.shape[0]):
+            row_scores = block.data[block.indptr[i]:block.indptr[i + 1]]
+            row_cols = block.indices[block.indptr[i]:block.indptr[i + 1]]
+
+            if len(row_scores) > k:
+                top = np.argpartition(-row_scores, k)[:k]
+                row_scores = row_scores[top]
+                row_cols = row_cols[top]
+
+            # best first, ties by recipe id
+            order = np.lexsort((row_cols, -row_scores))
+
+            for rank, j in enumerate(order, 1):
+                found.append((recipe_ids[start + i],
+                              recipe_ids[row_cols[j]],
+                              rank,
+                              float(row_scores[j])))
+
+    return found
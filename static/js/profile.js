@@ -74,10 +74,30 @@ $(document).on('mouseout', '.glyphicon-remove', function(evt) {
     $('.alert').css('color', '#333');
 });
 
-function updateMyRecipes(results) {
+function reloadPreview() {
     $.get('/preview.html', function(results) {
         $('#preview').html(results);
     });
+}
+
+// apply the change the server made, unless the shown boxes were already stale
+function updateMyRecipes(delta) {
+    var version = Number($('#editForm').attr('data-version'));
+
+    if (delta.version !== version + 1) {
+        reloadPreview();
+    } else {
+        var selector = '[data-box="' + delta.box_id + '"][data-recipe="' + delta.recipe_id + '"]';
+
+        if (delta.deleted) {
+            $('.glyphicon-remove' + selector).closest('.recbox-div').remove();
+        } else if (delta.notes !== undefined) {
+            $('.note-section' + selector).val(delta.notes).prevAll('.current-notes').text(delta.notes);
+        } else {
+            $('.box-label[data-box="' + delta.box_id + '"]').prevAll('.recbox-name').text(delta.label_name);
+        }
+        $('#editForm').attr('data-version', delta.version);
+    }
 
     $('#edit').click();
 }
@@ -6,8 +6,10 @@ $('.btn-primary').on('mouseout', function(evt) {
     $('.glyphicon-star').css('color', '#FFCC00');
 });
 
-function replaceNumbers(results) {
-    var newResults = JSON.parse(results);
+// amounts embedded by show_recipe, so serving changes need no request
+var payload = JSON.parse($('#amount-payload').text() || 'null');
+
+function replaceNumbers(newResults) {
 
     for (var i=0; i<newResults.length; i++) {
         var usAmount = newResults[i].us_amount;
@@ -25,13 +27,32 @@ function replaceNumbers(results) {
     }
 }
 
+// amounts for every serving size offered, formatted by the server
+function scaleLocally(serving) {
+    var amounts = payload.servings[serving];
+
+    for (var i=0; i<amounts.length; i++) {
+        if (amounts[i][0] !== null) {
+            $('#us'+i).html(amounts[i][0]);
+        }
+        if (amounts[i][1] !== null) {
+            $('#met'+i).html(amounts[i][1]);
+        }
+    }
+}
+
 function convert(evt) {
     evt.preventDefault();
     var info = {
         "serving": $('#serving').val(),
         "recipe_id": $('#recipe_id').val()
     };
-    $.get('/show_conversion.json', info, replaceNumbers);
+
+    if (payload && payload.servings[info.serving]) {
+        scaleLocally(info.serving);
+    } else {
+        $.get('/show_conversion.json', info, replaceNumbers);
+    }
 }
 
-$('#conversion').on('submit', convert);
\ No newline at end of file
+$('#conversion').on('submit', convert);
@@ -3,12 +3,25 @@ import unittest
 from server import app
 import server
 from model import db, connect_to_db
-from model import User, Box, RecipeBox, Recipe
+from model import User, Box, RecipeBox, Recipe, IngredientType, RecipeDocument, CatalogVersion, RecipeConversion
+from model import Ingredient, RecipeIngredient, RecipeServing, USIngredientMeasure
 from seed import example_recipes, example_user_boxes, load_users
 from StringIO import StringIO
 import json
 import bcrypt
 import webscrape_details
+from search_index import search_index, SearchIndex, IngredientVocabulary
+from functions import build_search_query, count_search_query, convert_ingredients
+from functions import convert_measures, pack_measures, scale_packed, FORMAT_VERSION
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from caches import search_cache, bump_catalog_version
+import caches
+from similarity import similar_recipes
+from units import to_base, rescale, choose_unit, choose_units
+from amounts import format_amount, format_amounts, format_amount_array
+import numpy as np
+from fractions import Fraction
 
 class GeneralUserTests(unittest.TestCase):
     """Tests routes for general user."""
@@ -110,9 +123,32 @@ class RouteDatabaseTests(unittest.TestCase):
         self.assertEqual(result.status_code, 200)
         self.assertIn("Produce", result.data)
         self.assertIn("Appetizer", result.data)
-        self.assertIn("medjool dates", result.data)
+        self.assertNotIn("medjool dates", result.data)
         self.assertIn("Search By Maximum Time", result.data)
 
+    def test_ingredient_names(self):
+        """Tests ingredient typeahead and ingredient names by type."""
+
+        produce = IngredientType.query.filter_by(type_name="Produce").first()
+
+        test_cases = [
+            ("/ingredients.json?q=Med", ["medjool dates"]),
+            ("/ingredients.json?q=sal", ["salsa", "each sea salt and black pepper", "sea salt"]),
+            ("/ingredients.json?q=onion&limit=1", ["red onion"]),
+            ("/ingredients.json?q=onion&limit=0", ["red onion"]),
+            ("/ingredients.json?q=onion&limit=-5", ["red onion"]),
+            ("/ingredients.json?q=xyz", []),
+            ("/ingredients.json?type_id=%s" % produce.type_id, sorted(i.ingredient_name for i in produce.ingredients))
+        ]
+
+        for case in test_cases:
+            route, expected_result = case[0], case[1]
+
+            result = self.client.get(route)
+
+            self.assertEqual(result.status_code, 200)
+            self.assertEqual(json.loads(result.data), expected_result)
+
     def test_results(self):
         """Tests search results."""
 
@@ -133,6 +169,165 @@ class RouteDatabaseTests(unittest.TestCase):
             self.assertIn(expected_result_2, result.data)
             self.assertNotIn(not_result, result.data)
 
+    def test_pantry_search(self):
+        """Tests if pantry search finds recipes made only from given ingredients."""
+
+        sashimi = ["avocado", "pickled ginger", "red onion", "sesame oil", "sesame seeds", "tamari", "wasabi", "watermelon"]
+        milky_way = ["medjool dates", "water", "almond flour", "coconut flour", "vegan dark chocolate"]
+
+        test_cases = [
+            ((sashimi, 0), [4]),
+            ((sashimi[:-1], 0), []),
+            ((sashimi[:-1], 1), [4]),
+            ((sashimi + milky_way, 0), [5, 4]),
+            (([], 5), [5]),
+            (([], 0), [])
+        ]
+
+        # a recipe without ingredients is never found
+        db.session.add(Recipe(recipe_name="Aaa Empty", time_in_min=1, src_url="", img_url=""))
+        db.session.commit()
+        bump_catalog_version()
+
+        for case in test_cases:
+            (ingredients, missing), expected_ids = case[0], case[1]
+
+            bitmap = search_index.match("pantry", ingredients, [], "", missing)
+            recipes = build_search_query("pantry", ingredients, [], "", missing).all()
+
+            self.assertEqual(search_index.recipe_ids_for(bitmap), expected_ids)
+            self.assertEqual([recipe.recipe_id for recipe in recipes], expected_ids)
+
+        result = self.client.get("/results?ingredient=avocado&ingredient=watermelon&time=&search-term=pantry&missing=6")
+
+        self.assertIn("Watermelon Sashimi", result.data)
+        self.assertNotIn("Cauliflower Rice Stuffed Peppers", result.data)
+
+    def test_result_facets(self):
+        """Tests recipe counts per course, ingredient type and time."""
+
+        facets = search_index.facets(search_index.match("any", ["avocado"], [], ""))
+
+        self.assertEqual(facets["total"], 2)
+        self.assertIn(("Side", 2), facets["courses"])
+        self.assertIn(("Produce", 2), facets["types"])
+        self.assertEqual(facets["times"], [(15, 1), (30, 1), (60, 1), (120, 2)])
+
+        result = self.client.get("/results?ingredient=avocado&time=&search-term=any")
+
+        self.assertIn("2 recipes found", result.data)
+        self.assertIn("side (2)", result.data)
+        self.assertIn("under 120 min (2)", result.data)
+
+        # without the index the same counts come from SQL
+        searches = [("any", ["avocado"], [], ""), ("all", ["garlic"], ["Side"], "60"),
+                    ("pantry", ["avocado", "watermelon"], [], ""), ("any", [], [], "")]
+        for search_term, ingredients, courses, time in searches:
+            facets = search_index.facets(search_index.match(search_term, ingredients, courses, time, 6))
+            query = build_search_query(search_term, ingredients, courses, time, 6)
+            self.assertEqual(count_search_query(query), facets)
+
+    def test_ranked_search(self):
+        """Tests if ranked search returns the top recipes by coverage."""
+
+        test_cases = [
+            ((["garlic", "yellow onion"], [], None, 24), [1, 2]),
+            ((["garlic", "yellow onion"], [], "60", 24), [2, 1]),
+            ((["garlic", "yellow onion", "watermelon", "avocado"], [], None, 2), [4, 2]),
+            (([], [], "60", 24), [5, 4]),
+            (([], [], None, 2), [2, 3])
+        ]
+
+        for case in test_cases:
+            search, expected_ids = case[0], case[1]
+
+            self.assertEqual(search_index.rank(*search), expected_ids)
+
+        result = self.client.get("/results?ingredient=garlic&ingredient=yellow+onion&ingredient=watermelon&ingredient=avocado&time=&search-term=any&order=rank")
+
+        self.assertEqual(result.status_code, 200)
+        self.assertLess(result.data.index("Watermelon Sashimi"), result.data.index("Cauliflower Rice Stuffed Peppers"))
+        self.assertNotIn("Vegan Milky Way", result.data)
+
+        result = self.client.get("/results?time=60&search-term=any&order=rank")
+
+        self.assertIn("Watermelon Sashimi", result.data)
+        self.assertNotIn("No recipes found", result.data)
+
+    def test_search_cache(self):
+        """Tests if equivalent searches are served from the search cache."""
+
+        search_cache.clear()
+        hits = search_cache.hits
+
+        self.client.get("/results?ingredient=tahini&ingredient=avocado&course=Side&time=&search-term=any")
+        result = self.client.get("/results?course=Side&ingredient=avocado&ingredient=tahini&ingredient=avocado&search-term=any")
+
+        self.assertEqual(search_cache.hits, hits + 1)
+        self.assertIn("Watermelon Sashimi", result.data)
+
+        # the SQL search is not served pages the index found
+        app.config["SEARCH_INDEX"] = False
+        self.client.get("/results?ingredient=tahini&ingredient=avocado&course=Side&time=&search-term=any")
+        app.config["SEARCH_INDEX"] = True
+
+        self.assertEqual(search_cache.hits, hits + 1)
+
+        stats = json.loads(self.client.get("/cache_stats.json").data)
+
+        self.assertEqual(stats["search"]["hits"], hits + 1)
+
+        app.config["TESTING"] = False
+        result = self.client.get("/cache_stats.json")
+        app.config["TESTING"] = True
+
+        self.assertEqual(result.status_code, 404)
+
+    def test_results_pages(self):
+        """Tests if search results are split into pages by recipe name."""
+
+        app.config["RESULTS_PER_PAGE"] = 2
+
+        test_cases = [
+            ("/results?time=&search-term=any", "Strawberry Rhubarb Crumble Bars", "Sun-Dried Tomato Chickpea Burgers", "after=3"),
+            ("/results?time=&search-term=any&after=3", "Vegan Milky Way", "Watermelon Sashimi", "after=5"),
+            ("/results?time=&search-term=any&after=5", "Watermelon Sashimi", "Vegan Milky Way", "Watermelon Sashimi")
+        ]
+
+        for search_index_on in [True, False]:
+            app.config["SEARCH_INDEX"] = search_index_on
+
+            for case in test_cases:
+                route, expected_result, not_result, next_page = case[0], case[1], case[2], case[3]
+
+                result = self.client.get(route)
+
+                self.assertEqual(result.status_code, 200)
+                self.assertIn(expected_result, result.data)
+                self.assertIn(next_page, result.data)
+                self.assertNotIn(not_result, result.data)
+
+            self.assertNotIn("More Results", result.data)
+
+            # a cursor for a recipe no longer in the catalog
+            result = self.client.get("/results?time=&search-term=any&after=999")
+            self.assertIn("No recipes found", result.data)
+
+        app.config["SEARCH_INDEX"] = True
+        app.config["RESULTS_PER_PAGE"] = 24
+
+    def test_results_flash(self):
+        """Tests a flashed message is shown once on streamed search results."""
+
+        with self.client.session_transaction() as sess:
+            sess["_flashes"] = [("message", "Logged in")]
+
+        result = self.client.get("/results?time=&search-term=any")
+        self.assertIn("Logged in", result.data)
+
+        result = self.client.get("/")
+        self.assertNotIn("Logged in", result.data)
+
     def test_recipe_details(self):
         """Tests recipe details."""
 
@@ -144,10 +339,267 @@ class RouteDatabaseTests(unittest.TestCase):
         self.assertIn("Dessert", result.data)
         self.assertNotIn("Save Recipe", result.data)
 
+    def test_recipe_page_cache(self):
+        """Tests recipe pages are served from cache and revalidated."""
+
+        result = self.client.get("/recipe/5")
+
+        self.assertEqual(result.status_code, 200)
+        etag = result.headers["ETag"]
+        last_modified = result.headers["Last-Modified"]
+
+        queries = []
+
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            queries.append(statement)
+
+        event.listen(Engine, "before_cursor_execute", count_query)
+        result = self.client.get("/recipe/5")
+
+        # only the version check
+        self.assertEqual(len(queries), 1)
+        self.assertIn("pitted medjool dates", result.data)
+        self.assertEqual(result.headers["ETag"], etag)
+
+        # a reseed by another process is seen on the next request
+        CatalogVersion.query.update({"version": "reseeded"})
+        db.session.commit()
+        del queries[:]
+        self.client.get("/recipe/5")
+        event.remove(Engine, "before_cursor_execute", count_query)
+
+        self.assertGreater(len(queries), 1)
+
+        result = self.client.get("/recipe/5", headers={"If-None-Match": etag})
+        self.assertEqual(result.status_code, 304)
+
+        result = self.client.get("/recipe/5", headers={"If-Modified-Since": last_modified})
+        self.assertEqual(result.status_code, 304)
+
+        # the logged-in page is a different variant
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = 1
+            sess["username"] = "Ada"
+
+        result = self.client.get("/recipe/5", headers={"If-None-Match": etag})
+        self.assertEqual(result.status_code, 200)
+        self.assertIn("Save Recipe", result.data)
+        self.assertNotIn("Last-Modified", result.headers)
+
+        result = self.client.get("/recipe/5", headers={"If-Modified-Since": last_modified})
+        self.assertEqual(result.status_code, 200)
+        self.assertIn("Save Recipe", result.data)
+
+        # pending messages are shown, not hidden behind a cached page
+        with self.client.session_transaction() as sess:
+            sess["_flashes"] = [("message", "Logged in")]
+
+        result = self.client.get("/recipe/5")
+        self.assertIn("Logged in", result.data)
+
+        result = self.client.get("/recipe/99")
+        self.assertEqual(result.status_code, 404)
+
+    def test_recipe_document(self):
+        """Tests recipe pages are rendered from a stored document."""
+
+        self.assertEqual(RecipeDocument.query.count(), Recipe.query.count())
+
+        queries = []
+
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            queries.append(statement)
+
+        event.listen(Engine, "before_cursor_execute", count_query)
+        result = self.client.get("/recipe/1")
+        event.remove(Engine, "before_cursor_execute", count_query)
+
+        # the version check and the document
+        self.assertEqual(len(queries), 2)
+        self.assertIn("Sun-Dried Tomato Chickpea Burgers", result.data)
+
+        result = self.client.get("/recipe/5.json")
+        document = json.loads(result.data)
+        self.assertEqual(document["recipe_name"], "Vegan Milky Way")
+        self.assertEqual(document["courses"], ["Dessert"])
+        self.assertEqual(len(document["ingredients"]), 5)
+
+        # a recipe without a document has it stored when first requested
+        RecipeDocument.query.filter_by(recipe_id=5).delete()
+        db.session.commit()
+
+        result = self.client.get("/recipe/5.json")
+        self.assertEqual(json.loads(result.data), document)
+        self.assertEqual(RecipeDocument.query.filter_by(recipe_id=5).count(), 1)
+
+        result = self.client.get("/recipe/99.json")
+        self.assertEqual(result.status_code, 404)
+
+    def test_amount_payload(self):
+        """Tests the recipe page embeds its amounts for scaling in the browser."""
+
+        result = self.client.get("/recipe/5")
+
+        payload = result.data.split('<script type="application/json" id="amount-payload">')[1].split("</script>")[0]
+        payload = json.loads(payload)
+        self.assertEqual(payload["serving"], 6)
+
+        # the same strings /show_conversion.json sends
+        for serving in ["1", "6", "12"]:
+            ingredients = json.loads(self.client.get("/show_conversion.json?recipe_id=5&serving=" + serving).data)
+            self.assertEqual(payload["servings"][serving],
+                             [[ingredient.get("us_amount"), ingredient.get("metric_amount")] for ingredient in ingredients])
+
+        self.assertEqual(payload["servings"]["12"][3], ["6 - 16 tbsp", "(90.00 - 240.00 ml)"])
+
     def test_conversion(self):
         """Tests ingredient conversions."""
 
-        pass
+        result = self.client.get("/show_conversion.json?recipe_id=5&serving=12")
+
+        self.assertEqual(result.status_code, 200)
+        ingredients = json.loads(result.data)
+        self.assertEqual(ingredients[0]["us_amount"], "30 - 60")
+        self.assertEqual(ingredients[3]["metric_amount"], "(90.00 - 240.00 ml)")
+
+        # unchanged conversions are not sent again
+        result = self.client.get("/show_conversion.json?recipe_id=5&serving=12",
+                                 headers={"If-None-Match": result.headers["ETag"]})
+        self.assertEqual(result.status_code, 304)
+
+        # conversions made by an older formatter are made again
+        RecipeConversion.query.filter_by(recipe_id=5).update({"format_version": FORMAT_VERSION - 1,
+                                                              "conversion": "[]"})
+        db.session.commit()
+        result = self.client.get("/show_conversion.json?recipe_id=5&serving=12")
+        self.assertEqual(json.loads(result.data), ingredients)
+        self.assertEqual(RecipeConversion.query.filter_by(recipe_id=5, format_version=FORMAT_VERSION).count(), 12)
+
+        result = self.client.get("/show_conversion.json?recipe_id=99&serving=12")
+        self.assertEqual(result.status_code, 404)
+
+    def test_conversion_queries(self):
+        """Tests converting a recipe takes the same queries whatever its size."""
+
+        queries = []
+
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            queries.append(statement)
+
+        counts = {}
+        event.listen(Engine, "before_cursor_execute", count_query)
+
+        # Vegan Milky Way has 5 ingredients, Sun-Dried Tomato Chickpea Burgers 15;
+        # conversions are read as stored, then made again from the document
+        for stored in [True, False]:
+            if not stored:
+                RecipeConversion.query.delete()
+                db.session.commit()
+
+            for recipe_id in [5, 1]:
+                del queries[:]
+                self.client.get("/show_conversion.json?recipe_id=%d&serving=8" % recipe_id)
+                counts[stored, recipe_id] = len(queries)
+
+        event.remove(Engine, "before_cursor_execute", count_query)
+
+        self.assertEqual(len(Recipe.query.get(1).recipesingredients), 15)
+        self.assertEqual(counts[True, 5], counts[True, 1])
+        self.assertEqual(counts[False, 5], counts[False, 1])
+        self.assertEqual(counts[True, 1], 1)
+        self.assertLessEqual(counts[False, 1], 3)
+
+    def test_scale_recipes(self):
+        """Tests batch conversions match single-recipe conversions."""
+
+        result = self.client.get("/scale_recipes.json?recipe_id=5&serving=12&recipe_id=1&serving=2&recipe_id=2&serving=3&recipe_id=99&serving=1")
+
+        self.assertEqual(result.status_code, 200)
+        scaled = json.loads(result.data)
+        self.assertEqual([(recipe["recipe_id"], recipe["serving"]) for recipe in scaled], [(5, 12), (1, 2), (2, 3)])
+
+        for recipe in scaled:
+            single = Recipe.query.get(recipe["recipe_id"])
+            conversion_amount = float(recipe["serving"]) / single.servings[0].serving_size
+            self.assertEqual(recipe["ingredients"], convert_ingredients(single, conversion_amount))
+
+        result = self.client.get("/scale_recipes.json?recipe_id=5&serving=12&recipe_id=1")
+        self.assertEqual(result.status_code, 400)
+
+    def test_similar_recipes(self):
+        """Tests similar recipes are ranked by shared ingredients."""
+
+        pairs = [(1, 1), (1, 2), (2, 1), (2, 2), (2, 3), (3, 3), (4, 9)]
+
+        found = [(recipe_id, similar_id, rank) for recipe_id, similar_id, rank, score in similar_recipes(pairs, k=2, block_size=2)]
+        self.assertEqual(found, [(1, 2, 1), (2, 1, 1), (2, 3, 2), (3, 2, 1)])
+
+        found = [(recipe_id, similar_id) for recipe_id, similar_id, rank, score in similar_recipes(pairs, k=1, metric="jaccard")]
+        self.assertEqual(found, [(1, 2), (2, 1), (3, 2)])
+
+        # salt (10) is in every recipe, so sharing it alone pairs nothing,
+        # but it still counts towards the scores of recipes that are paired
+        pairs = [(1, 10), (1, 1), (1, 2), (2, 10), (2, 1), (3, 10), (3, 3), (4, 10), (4, 4)]
+        found = similar_recipes(pairs, k=2, stop_share=0.5, stop_min=1)
+        self.assertEqual([(recipe_id, similar_id) for recipe_id, similar_id, rank, score in found], [(1, 2), (2, 1)])
+        self.assertAlmostEqual(found[0][3], 2 / np.sqrt(3 * 2), places=6)
+
+        result = self.client.get("/recipe/1")
+        self.assertIn("Similar Recipes", result.data)
+        self.assertIn('href="/recipe/2"', result.data)
+
+        # shares no ingredients with any other recipe
+        result = self.client.get("/recipe/5")
+        self.assertNotIn("Similar Recipes", result.data)
+
+    def test_search_index(self):
+        """Tests if search index matches recipes in recipe name order."""
+
+        test_cases = [
+            (("any", ["garlic", "watermelon"], [], ""), [2, 1, 4]),
+            (("all", ["avocado"], ["Side"], ""), [2, 4]),
+            (("all", ["red onion"], [], "60"), [4]),
+            (("any", [], [], ""), [2, 3, 1, 5, 4])
+        ]
+
+        for case in test_cases:
+            search, expected_ids = case[0], case[1]
+
+            bitmap = search_index.match(*search)
+
+            self.assertEqual(search_index.recipe_ids_for(bitmap), expected_ids)
+
+    def test_search_index_without_version(self):
+        """Tests an index is built for a database with no catalog version row."""
+
+        CatalogVersion.query.delete()
+        db.session.commit()
+        caches.catalog["version"] = None
+
+        index = SearchIndex()
+        bitmap = index.match("any", ["garlic", "watermelon"], [], "")
+
+        self.assertEqual(index.recipe_ids_for(bitmap), [2, 1, 4])
+
+        vocabulary = IngredientVocabulary()
+        self.assertIn("garlic", vocabulary.complete("garl"))
+
+    def test_search_query(self):
+        """Tests if single search query matches recipes in recipe name order."""
+
+        test_cases = [
+            (("any", ["garlic", "watermelon"], [], ""), [2, 1, 4]),
+            (("all", ["avocado"], ["Side"], ""), [2, 4]),
+            (("all", ["red onion"], [], "60"), [4]),
+            (("any", [], [], ""), [2, 3, 1, 5, 4])
+        ]
+
+        for case in test_cases:
+            search, expected_ids = case[0], case[1]
+
+            recipes = build_search_query(*search).all()
+
+            self.assertEqual([recipe.recipe_id for recipe in recipes], expected_ids)
 
 
 class DatabaseLoginTests(unittest.TestCase):
@@ -301,6 +753,27 @@ class DatabaseUserTests(unittest.TestCase):
                 box = Box.query.filter_by(box_id=box_id).first()
                 self.assertEqual(box.label_name, label_name)
 
+        # only the logged-in user's own boxes can be changed
+        result = self.client.post("/update_my_recipes",
+                                  data={"box_id": 1, "recipe_id": 4, "delete": "N", "notes": "Not found"})
+        self.assertEqual(result.status_code, 404)
+
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = 2
+
+        result = self.client.post("/update_my_recipes",
+                                  data={"box_id": 2, "recipe_id": -1, "delete": "N", "label_name": "Mine now"})
+        self.assertEqual(result.status_code, 404)
+        self.assertEqual(Box.query.get(2).label_name, "Lunch Menu")
+
+        with self.client.session_transaction() as sess:
+            del sess["user_id"]
+
+        result = self.client.post("/update_my_recipes",
+                                  data={"box_id": 1, "recipe_id": 1, "delete": "Y"})
+        self.assertEqual(result.status_code, 404)
+        self.assertTrue(RecipeBox.query.filter_by(box_id=1, recipe_id=1).first())
+
     def test_preview(self):
         """Tests preview of user's saved recipes."""
 
@@ -311,6 +784,171 @@ class DatabaseUserTests(unittest.TestCase):
         self.assertIn("My Notes:", result.data)
         self.assertIn("Need to buy ingredients", result.data)
 
+    def test_preview_delta(self):
+        """Tests updates return a delta and the preview is revalidated."""
+
+        result = self.client.get("/preview.html")
+        etag = result.headers["ETag"]
+
+        result = self.client.get("/preview.html", headers={"If-None-Match": etag})
+        self.assertEqual(result.status_code, 304)
+
+        # the ETag survives a restart, being built from the database
+        caches.catalog["version"] = None
+        caches.box_cache.clear()
+        result = self.client.get("/preview.html", headers={"If-None-Match": etag})
+        self.assertEqual(result.status_code, 304)
+
+        # and changes with an edit committed by another process
+        User.query.filter_by(user_id=1).update({"boxes_version": User.boxes_version + 1})
+        db.session.commit()
+        result = self.client.get("/preview.html", headers={"If-None-Match": etag})
+        self.assertEqual(result.status_code, 200)
+        etag = result.headers["ETag"]
+
+        result = self.client.post("/update_my_recipes",
+                                  data={"box_id": 2, "recipe_id": 4, "delete": "N", "notes": "Less salt"})
+        delta = json.loads(result.data)
+        self.assertEqual(delta["notes"], "Less salt")
+        self.assertEqual((delta["box_id"], delta["recipe_id"]), (2, 4))
+
+        result = self.client.post("/update_my_recipes",
+                                  data={"box_id": 2, "recipe_id": -1, "delete": "N", "label_name": "Lunch Menu"})
+        self.assertEqual(json.loads(result.data)["version"], delta["version"] + 1)
+
+        result = self.client.get("/preview.html", headers={"If-None-Match": etag})
+        self.assertEqual(result.status_code, 200)
+        self.assertIn("Less salt", result.data)
+        self.assertIn('data-version="%s"' % (delta["version"] + 1), result.data)
+
+    def test_batch_update(self):
+        """Tests a batch of box edits is applied in one transaction."""
+
+        operations = [
+            {"op": "create", "ref": "new", "label_name": "Brunch"},
+            {"op": "move", "box_id": 1, "recipe_id": 2, "to_box_id": "new"},
+            {"op": "notes", "box_id": 1, "recipe_id": 3, "notes": "Bought them"},
+            {"op": "rename", "box_id": 2, "label_name": "Sweets"},
+            {"op": "delete", "box_id": 2, "recipe_id": 5}
+        ]
+
+        result = self.client.post("/update_my_recipes.json",
+                                  data=json.dumps({"operations": operations}),
+                                  content_type="application/json")
+
+        self.assertEqual(result.status_code, 200)
+        new_box_id = json.loads(result.data)["created"]["new"]
+        self.assertEqual(Box.query.get(new_box_id).label_name, "Brunch")
+        self.assertEqual(RecipeBox.query.filter_by(recipe_id=2).one().box_id, new_box_id)
+        self.assertEqual(RecipeBox.query.filter_by(box_id=1, recipe_id=3).one().recipe_notes, "Bought them")
+        self.assertEqual(Box.query.get(2).label_name, "Sweets")
+        self.assertFalse(RecipeBox.query.filter_by(recipe_id=5).all())
+
+        # a recipe cannot be moved where it already is; nothing is changed
+        operations = [
+            {"op": "rename", "box_id": 2, "label_name": "Desserts"},
+            {"op": "move", "box_id": new_box_id, "recipe_id": 2, "to_box_id": new_box_id}
+        ]
+
+        result = self.client.post("/update_my_recipes.json",
+                                  data=json.dumps({"operations": operations}),
+                                  content_type="application/json")
+
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(Box.query.get(2).label_name, "Sweets")
+
+        # every edit must find its recipe, or the whole batch is rolled back
+        operations = [
+            {"op": "rename", "box_id": 2, "label_name": "Desserts"},
+            {"op": "notes", "box_id": 1, "recipe_id": 3, "notes": "Still need dates"},
+            {"op": "delete", "box_id": 1, "recipe_id": 5}
+        ]
+
+        result = self.client.post("/update_my_recipes.json",
+                                  data=json.dumps({"operations": operations}),
+                                  content_type="application/json")
+
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(Box.query.get(2).label_name, "Sweets")
+        self.assertEqual(RecipeBox.query.filter_by(box_id=1, recipe_id=3).one().recipe_notes, "Bought them")
+
+        for operation in [{"op": "notes", "box_id": 1, "recipe_id": 4, "notes": "Not here"},
+                          {"op": "move", "box_id": 1, "recipe_id": 5, "to_box_id": 2},
+                          {"op": "delete", "box_id": True, "recipe_id": 3},
+                          {"op": "move", "box_id": 1, "recipe_id": 3, "to_box_id": True},
+                          {"op": "rename", "box_id": 2, "label_name": 7},
+                          {"op": "notes", "box_id": 1, "recipe_id": 3, "notes": ["Bought them"]},
+                          {"op": "create", "ref": "new", "label_name": None},
+                          {"op": "drop", "box_id": 1}]:
+            result = self.client.post("/update_my_recipes.json",
+                                      data=json.dumps({"operations": [operation]}),
+                                      content_type="application/json")
+            self.assertEqual(result.status_code, 400)
+
+        self.assertEqual(RecipeBox.query.filter_by(box_id=1, recipe_id=3).one().recipe_notes, "Bought them")
+
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = 2
+
+        result = self.client.post("/update_my_recipes.json",
+                                  data=json.dumps({"operations": [{"op": "delete", "box_id": 1, "recipe_id": 1}]}),
+                                  content_type="application/json")
+        self.assertEqual(result.status_code, 404)
+
+    def test_scale_box(self):
+        """Tests batch conversions of a whole recipe box."""
+
+        result = self.client.get("/scale_recipes.json?box_id=1&serving=8")
+
+        self.assertEqual(result.status_code, 200)
+        scaled = json.loads(result.data)
+        self.assertEqual(sorted(recipe["recipe_id"] for recipe in scaled), [1, 2, 3])
+        self.assertEqual(set(recipe["serving"] for recipe in scaled), set([8]))
+
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = 2
+
+        result = self.client.get("/scale_recipes.json?box_id=1&serving=8")
+        self.assertEqual(result.status_code, 404)
+
+    def test_shopping_list(self):
+        """Tests the ingredients of boxes are combined and scaled."""
+
+        result = self.client.get("/shopping_list.json?box_id=1&box_id=2&serving=8")
+
+        self.assertEqual(result.status_code, 200)
+        shopping_list = json.loads(result.data)
+        items = dict((item["ingredient"], item) for item in shopping_list)
+        self.assertEqual([item["ingredient"] for item in shopping_list], sorted(items))
+        self.assertEqual(items["garlic"]["amounts"], ["18 cloves"])
+        self.assertEqual(items["garlic"]["recipes"], 2)
+        self.assertEqual(items["chickpeas"]["amounts"], ["3 cups"])
+
+        result = self.client.get("/shopping_list.json?box_id=1&box_id=99")
+        self.assertEqual(result.status_code, 404)
+
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = 2
+
+        result = self.client.get("/shopping_list.json?box_id=1")
+        self.assertEqual(result.status_code, 404)
+
+    def test_shopping_list_metric_and_servings(self):
+        """Tests metric-only ingredients are totaled and a recipe is scaled from one serving."""
+
+        tahini = RecipeIngredient.query.join(Ingredient).filter(Ingredient.ingredient_name == "tahini").one()
+        USIngredientMeasure.query.filter_by(recipeingredient_id=tahini.recipeingredient_id).delete()
+        db.session.add(RecipeServing(recipe_id=tahini.recipe_id, serving_id=3))
+        db.session.commit()
+
+        result = self.client.get("/shopping_list.json?box_id=1&box_id=2&serving=8")
+
+        self.assertEqual(result.status_code, 200)
+        items = dict((item["ingredient"], item) for item in json.loads(result.data))
+        self.assertEqual(items["tahini"]["amounts"], ["90 g"])
+        self.assertEqual(items["garlic"]["amounts"], ["18 cloves"])
+        self.assertEqual(items["garlic"]["recipes"], 2)
+
     def test_upload(self):
         """Tests profile picture upload."""
 
@@ -465,6 +1103,99 @@ class DatabaseUserTests(unittest.TestCase):
         self.assertEqual(result.status_code, 200)
         self.assertEqual(label_data["name"], "Party Food")
         self.assertEqual(recipe_data["name"], "Sun-Dried Tomato Chickpea Burgers")
+        self.assertEqual(recipe_data["parent"], label_data["id"])
+        self.assertEqual(len(data), 1 + 2 + 5)
+        self.assertEqual(len(set(node["id"] for node in data)), len(data))
+
+        # a session whose user is not in the database has only the root
+        with self.client.session_transaction() as sess:
+            sess["user_id"] = 99
+
+        for route in ["/my_recipes.json", "/preview.html", "/save_recipe/1"]:
+            result = self.client.get(route)
+            self.assertEqual(result.status_code, 200)
+
+        result = self.client.get("/my_recipes.json")
+        self.assertEqual([node["id"] for node in json.loads(result.data)], ["root"])
+
+    def test_my_recipe_json_lazy(self):
+        """Tests labels come with counts and their recipes a page at a time."""
+
+        full = json.loads(self.client.get("/my_recipes.json").data)
+
+        labels = json.loads(self.client.get("/my_recipes.json?lazy=1").data)
+        self.assertEqual([node["id"] for node in labels],
+                         [node["id"] for node in full if "url" not in node])
+        self.assertEqual(sum(node.get("count", 0) for node in labels), 5)
+
+        label = labels[1]
+        app.config['BOX_PAGE_SIZE'] = 1
+        try:
+            nodes = []
+            after = None
+            while True:
+                url = "/my_recipes.json?box_id=%d" % label["box_id"]
+                if after is not None:
+                    url += "&after=%d" % after
+                page = json.loads(self.client.get(url).data)
+                self.assertLessEqual(len(page["nodes"]), 1)
+                nodes.extend(page["nodes"])
+                after = page["after"]
+                if after is None:
+                    break
+        finally:
+            app.config['BOX_PAGE_SIZE'] = 24
+
+        self.assertEqual(len(nodes), label["count"])
+        self.assertEqual(nodes, [node for node in full if node["parent"] == label["id"]])
+
+        result = self.client.get("/my_recipes.json?box_id=12345")
+        self.assertEqual(result.status_code, 404)
+
+    def test_box_cache(self):
+        """Tests box pages are served from cache until the boxes change."""
+
+        queries = []
+
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            queries.append(statement)
+
+        event.listen(Engine, "before_cursor_execute", count_query)
+        self.client.get("/my_recipes.json")
+        # the version check, then the whole view in one query, however
+        # many boxes there are
+        self.assertEqual(len(queries), 2)
+
+        del queries[:]
+        self.client.get("/my_recipes.json")
+        self.client.get("/preview.html")
+        self.client.get("/profile")
+        event.remove(Engine, "before_cursor_execute", count_query)
+
+        # only the version check of each request
+        self.assertEqual(len(queries), 3)
+
+        # an edit committed by another process is seen on the next request
+        RecipeBox.query.filter_by(box_id=1, recipe_id=1).update({"recipe_notes": "Grill them"})
+        User.query.filter_by(user_id=1).update({"boxes_version": User.boxes_version + 1})
+        db.session.commit()
+        result = self.client.get("/preview.html")
+        self.assertIn("Grill them", result.data)
+
+        self.client.post("/update_my_recipes",
+                         data={"box_id": 1, "recipe_id": 2, "notes": "Double the avocado"})
+        result = self.client.get("/preview.html")
+        self.assertIn("Double the avocado", result.data)
+
+        self.client.post("/update_my_recipes",
+                         data={"box_id": 1, "recipe_id": -1, "label_name": "Game Night"})
+        data = json.loads(self.client.get("/my_recipes.json").data)
+        self.assertEqual(data[1]["name"], "Game Night")
+
+        self.client.post("/settings",
+                         data={"username": "Ada2", "password": ""})
+        result = self.client.get("/profile")
+        self.assertIn("Hi, Ada2", result.data)
 
 
 class ModelTests(unittest.TestCase):
@@ -533,6 +1264,123 @@ class HelperFunctionsTests(unittest.TestCase):
         pass
 
 
+class AmountFormatTests(unittest.TestCase):
+    """Tests formatting of scaled US amounts."""
+
+    def test_format_amount(self):
+        """Tests amounts are shown as whole numbers and fractions."""
+
+        test_cases = [
+            (1.5, "1 1/2"),
+            (0.75, "3/4"),
+            (3.0, "3"),
+            (0.67, "2/3"),
+            (2.99, "3"),
+            (0.01, "0")
+        ]
+
+        for case in test_cases:
+            value, expected_amount = case[0], case[1]
+
+            self.assertEqual(format_amount(value), expected_amount)
+
+    def test_format_amounts(self):
+        """Tests table lookups match Fraction.limit_denominator."""
+
+        test_cases = [
+            (0.5, "1/2"),
+            (1.5, "1 1/2"),
+            (2.0, "2"),
+            (2.99, "3"),
+            (0.99, "1"),
+            (0.01, "0"),
+            (1 / 3.0, "1/3"),
+            (1 / 12.0, "1/12"),
+            (1.2, "1 1/5"),
+            (0.3125, "5/16"),
+            (11 / 3.0, "3 2/3"),
+            (0.03125, "1/32")
+        ]
+
+        for value, expected_amount in test_cases:
+            self.assertEqual(format_amount(value), expected_amount)
+            self.assertEqual(format_amounts([value]), [expected_amount])
+            self.assertEqual(format_amount_array(np.array([value])), [expected_amount])
+
+        values = [amount / 100.0 * serving / 12 for amount in range(1, 300) for serving in range(1, 13)]
+
+        for value, amount in zip(values, format_amounts(values)):
+            fraction = Fraction(value).limit_denominator(32)
+            if fraction.denominator == 1:
+                expected_amount = str(fraction.numerator)
+            elif value < 1:
+                expected_amount = str(fraction)
+            else:
+                expected_amount = "%d %s" % (int(value), Fraction(value - int(value)).limit_denominator(32))
+
+            self.assertEqual(amount, expected_amount)
+
+        self.assertEqual(format_amount_array(np.array(values)), format_amounts(values))
+
+
+    def test_scale_without_units(self):
+        """Tests amounts without a unit are scaled and shown alone."""
+
+        all_measures = [{'original_string': "2 limes", 'link': None,
+                         'us_amounts': [2], 'us_units': [],
+                         'metric_amounts': [2, 3], 'metric_units': []}]
+
+        for conversion_amount in [1, 1.5]:
+            expected = [{'ingredient': "2 limes", 'extlink': None,
+                         'us_amount': format_amount(2 * conversion_amount),
+                         'metric_amount': "(%.2f - %.2f)" % (2 * conversion_amount, 3 * conversion_amount)}]
+
+            self.assertEqual(convert_measures(all_measures, conversion_amount), expected)
+            self.assertEqual(scale_packed([pack_measures(all_measures, 4)], [conversion_amount]), [expected])
+
+
+class UnitTests(unittest.TestCase):
+    """Tests converting and rescaling units."""
+
+    def test_to_base(self):
+        """Tests amounts are converted to their dimension's base unit."""
+
+        self.assertEqual(to_base(2, "cups"), (96, "tsp"))
+        self.assertEqual(to_base(1.5, "tbsp"), (4.5, "tsp"))
+        self.assertEqual(to_base(2, "kg"), (2000, "g"))
+        self.assertEqual(to_base(1, "15-ounce can"), (1, "15-ounce can"))
+
+    def test_rescale(self):
+        """Tests scaled amounts are shown in the unit that reads best."""
+
+        test_cases = [
+            ([48.0], "tsp", [1.0], "cup"),
+            ([15.0], "tsp", [5.0], "tbsp"),
+            ([42.0], "tsp", [14.0], "tbsp"),
+            ([12.0, 32.0], "tbsp", [0.75, 2.0], "cups"),
+            ([72.0], "tsp", [1.5], "cups"),
+            ([48.375], "tsp", [1.0078125], "cup"),
+            ([6.0, 16.0], "tbsp", [6.0, 16.0], "tbsp"),
+            ([1500.0], "ml", [1.5], "l"),
+            ([3.0], "cloves", [3.0], "cloves"),
+            ([1.0], None, [1.0], None)
+        ]
+
+        for amounts, unit, expected_amounts, expected_unit in test_cases:
+            self.assertEqual(rescale(amounts, unit), (expected_amounts, expected_unit))
+
+    def test_choose_units(self):
+        """Tests choosing units for an array matches choose_unit."""
+
+        base_amounts = np.array([amount / 8.0 for amount in range(1, 800)])
+
+        for dimension in ["us volume", "metric weight"]:
+            sizes, names = choose_units(base_amounts, np.array([dimension] * len(base_amounts), dtype=object))
+            expected = [choose_unit(base_amount, dimension) for base_amount in base_amounts]
+
+            self.assertEqual(zip(names.tolist(), sizes.tolist()), expected)
+
+
 class SeedDatabaseTests(unittest.TestCase):
     """Tests single functions."""
 
@@ -0,0 +1,237 @@
+"""Canonical units for US and metric measures, and the units to show them in.
+
+Every known unit is a size in the base unit of its dimension: teaspoons
+for US volume, ounces for US weight, milliliters and grams for metric.
+Amounts are compared and summed in base units, and shown in whichever
+unit of their dimension reads best, so 48 tsp is shown as 1 cup and
+1/12 cup as 1 1/3 tbsp.
+"""
+
+import numpy as np
+from amounts import MAX_DENOMINATOR
+
+# dimension and size in the dimension's base unit, by canonical unit name
+UNITS = {
+    "pinch": ("us volume", 0.0625),
+    "dash": ("us volume", 0.125),
+    "tsp": ("us volume", 1.0),
+    "tbsp": ("us volume", 3.0),
+    "cup": ("us volume", 48.0),
+    "oz": ("us weight", 1.0),
+    "lb": ("us weight", 16.0),
+    "ml": ("metric volume", 1.0),
+    "l": ("metric volume", 1000.0),
+    "g": ("metric weight", 1.0),
+    "kg": ("metric weight", 1000.0),
+    "clove": ("clove", 1.0),
+    "head": ("head", 1.0),
+}
+
+# other spellings of the same units in scraped recipes
+ALIASES = {
+    "pinches": "pinch",
+    "dashes": "dash",
+    "tsps": "tsp",
+    "tbsps": "tbsp",
+    "cups": "cup",
+    "ounce": "oz",
+    "ounces": "oz",
+    "pound": "lb",
+    "pounds": "lb",
+    "liter": "l",
+    "liters": "l",
+    "cloves": "clove",
+    "heads": "head",
+}
+
+# base unit of each dimension
+BASE_UNITS = {
+    "us volume": "tsp",
+    "us weight": "oz",
+    "metric volume": "ml",
+    "metric weight": "g",
+    "clove": "clove",
+    "head": "head",
+}
+
+# units amounts are shown in, largest first, with the least and most
+# shown in each, e.g. no more than 16 tbsp, which is a cup
+DISPLAY_UNITS = {
+    "us volume": [("cup", 0.25, float("inf")), ("tbsp", 1.0, 16.0), ("tsp", 0.0, 3.0)],
+    "us weight": [("lb", 1.0, float("inf")), ("oz", 0.0, 16.0)],
+    "metric volume": [("l", 1.0, float("inf")), ("ml", 0.0, 1000.0)],
+    "metric weight": [("kg", 1.0, float("inf")), ("g", 0.0, 1000.0)],
+}
+
+# display units written differently for more than one, e.g. "2 cups"
+PLURALS = {"cup": "cups"}
+
+# amounts within this of a whole, half, third or quarter read well
+NICE_DENOMINATORS = [1, 2, 3, 4]
+NICE_TOLERANCE = 0.01
+
+
+def build_unit_table():
+    """Return (canonical name, dimension, size) for every spelling of a unit."""
+
+    table = {}
+
+    for name, (dimension, size) in UNITS.items():
+        table[name] = (name, dimension, size)
+
+    for alias, name in ALIASES.items():
+        table[alias] = table[name]
+
+    return table
+
+
+unit_table = build_unit_table()
+
+
+def unit_info(unit):
+    """Return (canonical name, dimension, size in base unit) of unit, or None."""
+
+    return unit_table.get(unit)
+
+
+def to_base(amount, unit):
+    """Return (amount, unit) in the base unit of unit's dimension.
+
+    Amounts in unknown units, like "15-ounce can", are returned as they are.
+    """
+
+    info = unit_table.get(unit)
+    if not info:
+        return amount, unit
+
+    name, dimension, size = info
+
+    return amount * size, BASE_UNITS[dimension]
+
+
+def is_nice(value):
+    """Return whether value is close to a whole, half, third or quarter."""
+
+    for denominator in NICE_DENOMINATORS:
+        if abs(value - round(value * denominator) / float(denominator)) < NICE_TOLERANCE:
+            return True
+
+    return False
+
+
+def is_nice_array(values):
+    """Return is_nice of each of an array of values."""
+
+    nice = np.zeros(len(values), dtype=bool)
+
+    for denominator in NICE_DENOMINATORS:
+        nice |= np.abs(values - np.round(values * denominator) / float(denominator)) < NICE_TOLERANCE
+
+    return nice
+
+
+def choose_unit(base_amount, dimension):
+    """Return (name, size) of the unit to show a base amount of dimension in.
+
+    The largest unit the amount is a nice fraction of, within the least
+    and most shown in it, is chosen; failing that, the largest unit it is
+    at least the least of.
+    """
+
+    display_units = DISPLAY_UNITS[dimension]
+
+    for name, least, most in display_units:
+        size = UNITS[name][1]
+        value = base_amount / size
+        if least <= value < most and is_nice(value):
+            return name, size
+
+    for name, least, most in display_units:
+        size = UNITS[name][1]
+        if base_amount / size >= least:
+            return name, size
+
+    name = display_units[-1][0]
+
+    return name, UNITS[name][1]
+
+
+def unit_name(name, amounts):
+    """Return the name amounts in unit name are shown with, plural for more than one.
+
+    Amounts that are shown as 1, like 1.01, count as one.
+    """
+
+    if name in PLURALS and round(max(amounts) * MAX_DENOMINATOR) > MAX_DENOMINATOR:
+        return PLURALS[name]
+
+    return name
+
+
+def rescale(amounts, unit):
+    """Return (amounts, unit) shown in the unit that reads best.
+
+    The unit is chosen by the first amount, so both ends of a range stay
+    in the same unit. Amounts in units without display units (cloves,
+    cans) or without a unit are returned as they are. The unit is
+    named for the amounts, e.g. "cups" for more than one.
+    """
+
+    info = unit_table.get(unit)
+    if not info or info[1] not in DISPLAY_UNITS:
+        return amounts, unit
+
+    name, dimension, size = info
+    chosen, chosen_size = choose_unit(amounts[0] * size, dimension)
+
+    amounts = [amount * size / chosen_size for amount in amounts]
+
+    return amounts, unit_name(chosen, amounts)
+
+
+def rescale_info(unit):
+    """Return (dimension, size) of unit for choose_units.
+
+    The dimension is "" for units rescale leaves as they are.
+    """
+
+    info = unit_table.get(unit)
+    if not info or info[1] not in DISPLAY_UNITS:
+        return "", 1.0
+
+    return info[1], info[2]
+
+
+def choose_units(base_amounts, dimensions):
+    """Return the sizes and names of the units to show base amounts in.
+
+    dimensions is an array of dimension names, with "" where no unit is
+    to be chosen (size 1.0, name None). Gives the same units as
+    choose_unit for each amount.
+    """
+
+    sizes = np.ones(len(base_amounts))
+    names = np.empty(len(base_amounts), dtype=object)
+
+    for dimension, display_units in DISPLAY_UNITS.items():
+        undecided = dimensions == dimension
+        if not undecided.any():
+            continue
+
+        for nice_only in [True, False]:
+            for name, least, most in display_units:
+                size = UNITS[name][1]
+                value = base_amounts / size
+                chosen = undecided & (value >= least)
+                if nice_only:
+                    chosen &= (value < most) & is_nice_array(value)
+
+                sizes[chosen] = size
+                names[chosen] = name
+                undecided &= ~chosen
+
+        name = display_units[-1][0]
+        sizes[undecided] = UNITS[name][1]
+        names[undecided] = name
+
+    return sizes, names